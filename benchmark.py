@@ -0,0 +1,347 @@
+"""Benchmarks for the editing and service paths of main.py
+
+Runs the display resize, the local fallbacks of every *_with_service edit,
+ImageProperties.extract_data and ZMQ round trips (protocols v1, v2 with each
+payload codec, and v3) against the reference grayscale service on synthetic
+images, and reports p50/p99 latency and throughput. Every size and mode runs
+in a fresh process, image_peak_rss_mb is the peak RSS of that process over
+all cases of the image. Before timing anything, EditGraph.render() is checked
+against applying random edit chains one at a time. Results are written to
+benchmarks/<commit>.json so two commits can be compared:
+
+    python benchmark.py --sizes 0.5,2 --modes RGB
+    python benchmark.py --compare benchmarks/abc1234.json benchmarks/def5678.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import PIL
+from PIL import Image, ImageChops
+
+import main
+import server as reference_server
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is reported as None there
+    resource = None
+
+DEFAULT_SIZES = "0.5,2,8,24,50"
+DEFAULT_MODES = "RGB,RGBA,L"
+STAND_IN_ENDPOINT = "tcp://127.0.0.1:5599"
+
+def synthetic_image(megapixels, mode):
+    """Deterministic test image of about megapixels with some structure in every band"""
+    width = int((megapixels * 1000000 * 4 / 3) ** 0.5)
+    height = int(megapixels * 1000000 / width)
+    gradient = Image.linear_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    radial = Image.radial_gradient('L').resize((width, height))
+    if mode == 'L':
+        return Image.blend(gradient, noise, 0.3)
+    bands = [gradient, noise, radial]
+    if mode == 'RGBA':
+        bands.append(gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT))
+    return Image.merge(mode, bands)
+
+def peak_rss_mb():
+    """Peak RSS of this process so far, it never goes down"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def measure(work, repeats, min_seconds):
+    """Run work at least repeats times (and for min_seconds) and return the latencies in ms"""
+    work()  # Warm up caches and connections
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < repeats or time.perf_counter() - started < min_seconds:
+        before = time.perf_counter()
+        work()
+        timings.append((time.perf_counter() - before) * 1000)
+        if len(timings) >= 1000:
+            break
+    return sorted(timings)
+
+def summarize(name, image, timings):
+    p50 = timings[len(timings) // 2]
+    return {
+        "case": name,
+        "mode": image.mode,
+        "size": list(image.size),
+        "megapixels": round(image.width * image.height / 1000000, 2),
+        "runs": len(timings),
+        "p50_ms": round(p50, 3),
+        "p99_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.99))], 3),
+        "megapixels_per_second": round(image.width * image.height / 1000 / p50, 2) if p50 else None
+    }
+
+def random_edits(rng, size, count):
+    """A random edit chain that is valid for an image of size"""
+    width, height = size
+    operations = []
+    for _ in range(count):
+        name = rng.choice(("crop", "resize", "brightness", "contrast", "grayscale"))
+        if name == "crop" and width > 8 and height > 8:
+            left, top = rng.randrange(width // 2), rng.randrange(height // 2)
+            right, bottom = rng.randrange(left + 4, width + 1), rng.randrange(top + 4, height + 1)
+            operations.append(("crop", (left, top, right, bottom)))
+            width, height = right - left, bottom - top
+        elif name == "resize":
+            width, height = max(4, int(width * rng.uniform(0.3, 2))), max(4, int(height * rng.uniform(0.3, 2)))
+            operations.append(("resize", (width, height)))
+        elif name == "brightness":
+            operations.append(("brightness", round(rng.uniform(0.5, 1.5), 2)))
+        elif name == "contrast":
+            operations.append(("contrast", round(rng.uniform(0.5, 1.5), 2), rng.uniform(0, 255)))
+        elif name == "grayscale":
+            operations.append(("grayscale", None))
+    return operations
+
+def check_edit_graph(chains, tolerance=8, seed=361):
+    """Compare EditGraph.render() with applying each edit on its own, as the services do
+
+    The planned render reorders and fuses edits, which may only change
+    pixels by rounding, though later contrast edits amplify it. Raises on a
+    chain whose results differ by more than tolerance levels.
+    """
+    rng = random.Random(seed)
+    point_ops = main.PointOpEngine()
+    worst = 0
+    for _ in range(chains):
+        image = synthetic_image(0.02, rng.choice(("RGB", "RGBA", "L")))
+        operations = random_edits(rng, image.size, rng.randint(1, 6))
+        graph = main.EditGraph(image, point_ops)
+        expected = image
+        for operation in operations:
+            graph.push(*operation)
+            expected = main.service_operation(operation, point_ops)[2](expected)
+        rendered = graph.render()
+        if rendered.size != expected.size or rendered.mode != expected.mode:
+            raise AssertionError(f"{operations}: rendered {rendered.mode} {rendered.size}, "
+                                 f"expected {expected.mode} {expected.size}")
+        extrema = ImageChops.difference(rendered, expected).getextrema()
+        difference = extrema[1] if rendered.mode == 'L' else max(high for _, high in extrema)
+        if difference > tolerance:
+            raise AssertionError(f"{operations}: render differs from sequential edits by {difference} levels")
+        worst = max(worst, difference)
+    print(f"Edit graph: {chains} random chains match sequential edits (max difference {worst})")
+
+def display_case(image):
+    """The viewer's first display of an image, with a real Tk label when there is a display"""
+    try:
+        import tkinter as tk
+        root = tk.Tk()
+        root.withdraw()
+    except Exception:
+        root = None
+
+    if root is None:
+        # Headless: time the resample only, PhotoImage needs a display
+        def work():
+            pyramid = main.DisplayPyramid(image)
+            pyramid.level_for(1280, 720).resize((1280, 720), Image.Resampling.LANCZOS)
+        return "display_resample", work, None
+
+    viewer = type("Viewer", (), {})()
+    viewer.window = root
+    viewer.image_label = tk.Label(root)
+    viewer.display_quality = 'high'
+    viewer.refine_job = None
+
+    def work():
+        viewer.display_pyramid = None
+        main.ImageViewer.resize_image(viewer, image, 1280, 720, 'high')
+    return "display_resize_image", work, root
+
+def run_cases(image, args, services, workdir):
+    results = []
+
+    def record(name, work):
+        timings = measure(work, args.repeats, args.min_seconds)
+        result = summarize(name, image, timings)
+        print(f"{name:24} {image.mode:4} {result['megapixels']:6} MP  "
+              f"p50 {result['p50_ms']:9.2f} ms  p99 {result['p99_ms']:9.2f} ms  "
+              f"{result['megapixels_per_second']} MP/s")
+        results.append(result)
+
+    name, work, root = display_case(image)
+    record(name, work)
+    if root is not None:
+        root.destroy()
+
+    point_ops = main.PointOpEngine()
+    width, height = image.size
+    operations = [
+        ("grayscale", None),
+        ("resize", (width // 2, height // 2)),
+        ("crop", (width // 4, height // 4, width * 3 // 4, height * 3 // 4)),
+        ("brightness", 1.2),
+        ("contrast", 1.3)
+    ]
+    for operation in operations:
+        local_operation = main.service_operation(operation, point_ops)[2]
+        record(f"local_{operation[0]}", lambda: local_operation(image))
+
+    # Properties of a saved file, from the header without the microservice
+    path = os.path.join(workdir, f"bench_{image.mode}_{width}x{height}.png")
+    image.save(path, compress_level=1)
+    properties = main.ImageProperties()
+    record("extract_data", lambda: properties.extract_data(path))
+    os.remove(path)
+
+    if services is not None:
+        endpoint = services.endpoints["grayscale"][0]
+        services.negotiate_protocol(endpoint)
+        cases = [(main.PROTOCOL_JSON, None)]
+        cases += [(main.PROTOCOL_BINARY, codec) for codec in args.codecs.split(',')
+                  if main.codec_family(codec) in services.codecs.get(endpoint, ())]
+        cases.append((main.PROTOCOL_SHM, None))
+        for protocol, codec in cases:
+            if protocol == main.PROTOCOL_JSON and width * height > args.max_json_mp * 1000000:
+                # PNG + base64 takes seconds per megapixel, skip it on big images
+                continue
+            def round_trip():
+                services.protocols[endpoint] = protocol
+                services.codec_setting["grayscale"] = codec or "raw"
+                response, result = services.request_endpoint(endpoint, "grayscale", {"command": "grayscale"}, image)
+                if result is None:
+                    raise RuntimeError(response.get("error"))
+            # Raw v2 keeps its old case name so earlier results still compare
+            suffix = f"_{codec}" if codec not in (None, "raw") else ""
+            record(f"zmq_v{protocol}{suffix}_grayscale", round_trip)
+    return results
+
+def service_config():
+    return {
+        "GRAYSCALE_ENDPOINT": STAND_IN_ENDPOINT,
+        "GRAYSCALE_TIMEOUT_MS": "120000",
+        "ZMQ_RETRIES": "0",
+        "ADAPTIVE_ROUTING": "0"
+    }
+
+def measure_image(megapixels, mode, args, workdir):
+    """Run every case for one size and mode, in a process of its own so the peak RSS is its own"""
+    services = None if args.no_services else main.ImageServices(service_config())
+    try:
+        image = synthetic_image(megapixels, mode)
+        results = run_cases(image, args, services, workdir)
+    finally:
+        if services is not None:
+            services.close(quit_servers=False)
+    peak = peak_rss_mb()
+    print(f"{'peak RSS':24} {mode:4} {results[0]['megapixels']:6} MP  {peak} MB")
+    for result in results:
+        result["image_peak_rss_mb"] = peak
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return "unknown"
+
+def compare(old_path, new_path):
+    """Print the p50 change of every case present in both result files"""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    key = lambda result: (result["case"], result["mode"], result["megapixels"])
+    baseline = {key(result): result for result in old["results"]}
+    print(f"{old['commit']} -> {new['commit']}")
+    for result in new["results"]:
+        before = baseline.get(key(result))
+        if before is None or not before["p50_ms"]:
+            continue
+        change = (result["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100
+        flag = "  <-- slower" if change > 10 else ""
+        print(f"{result['case']:24} {result['mode']:4} {result['megapixels']:6} MP  "
+              f"{before['p50_ms']:9.2f} -> {result['p50_ms']:9.2f} ms  {change:+6.1f}%{flag}")
+
+def run(args):
+    check_edit_graph(args.check_chains)
+
+    sizes = [float(size) for size in args.sizes.split(',')]
+    modes = args.modes.split(',')
+
+    server = None
+    services = None
+    workdir = tempfile.mkdtemp(prefix="image-bench-")
+    cwd = os.getcwd()
+    try:
+        # ImageProperties reads its settings from .env in the working directory
+        os.chdir(workdir)
+        with open(".env", "w") as f:
+            f.write("SVC_URL=127.0.0.1\nFLASK_RUN_PORT=9\nAPI_ENDPOINT=properties\n")
+
+        if not args.no_services:
+            # The reference grayscale service with a single worker
+            server = multiprocessing.Process(target=reference_server.serve, args=("grayscale", STAND_IN_ENDPOINT, 1))
+            server.start()
+            # Only used to stop the server, the cases connect from their own process
+            services = main.ImageServices(service_config())
+
+        # Spawned rather than forked, so no memory of this process counts toward the peak
+        context = multiprocessing.get_context("spawn")
+        results = []
+        for megapixels in sizes:
+            for mode in modes:
+                with context.Pool(1) as pool:
+                    results.extend(pool.apply(measure_image, (megapixels, mode, args, workdir)))
+    finally:
+        if services is not None:
+            services.client.request(STAND_IN_ENDPOINT, [b"Q"], timeout=1000, retries=0)
+            services.close(quit_servers=False)
+        if server is not None:
+            server.join(5)
+        os.chdir(cwd)
+
+    report = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "results": results
+    }
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"Results written to {output}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the editing and service paths")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma separated image sizes in megapixels")
+    parser.add_argument("--modes", default=DEFAULT_MODES, help="comma separated image modes")
+    parser.add_argument("--repeats", type=int, default=5, help="minimum runs per case")
+    parser.add_argument("--min-seconds", type=float, default=1.0, help="minimum time spent per case")
+    parser.add_argument("--no-services", action="store_true", help="skip the ZMQ round trips")
+    parser.add_argument("--max-json-mp", type=float, default=8, help="largest image for the v1 JSON round trip")
+    parser.add_argument("--codecs", default="raw,zlib-1,zlib-6,webp",
+                        help="comma separated payload codecs for the v2 round trip")
+    parser.add_argument("--check-chains", type=int, default=200,
+                        help="random edit chains compared between EditGraph.render() and sequential edits")
+    parser.add_argument("--output", default=None, help="result file, defaults to benchmarks/<commit>.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        run(args)
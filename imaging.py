@@ -0,0 +1,278 @@
+"""Image helpers shared by the viewer and the reference services
+
+Wire protocol constants, raw pixel packing, the payload codecs, shared memory
+transport and the point operation engine. Nothing here needs a display or
+the viewer's dependencies, so service hosts only need Pillow (and pyzmq for
+server.py).
+"""
+import io
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from multiprocessing import shared_memory
+
+from PIL import Image, ImageStat
+
+# Wire protocol versions spoken with the ZMQ services. Version 1 is the original
+# single JSON string carrying a base64 encoded PNG, version 2 is a multipart
+# message made of a small JSON header frame followed by the raw pixel buffer.
+# Version 3 is only offered to services on this host: the pixels are placed in
+# a shared memory segment and only its name and geometry go over the socket.
+PROTOCOL_JSON = 1
+PROTOCOL_BINARY = 2
+PROTOCOL_SHM = 3
+SUPPORTED_PROTOCOLS = [PROTOCOL_BINARY, PROTOCOL_JSON]
+
+# Modes that can be sent as a raw pixel buffer without conversion
+RAW_MODES = ("1", "L", "LA", "P", "RGB", "RGBA", "RGBX", "CMYK", "I", "F", "I;16")
+
+def pack_image(image):
+    """Split an image into a geometry dict and its raw pixel buffer"""
+    if image.mode not in RAW_MODES:
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+    pixels = image.tobytes()
+    geometry = {
+        "mode": image.mode,
+        "size": list(image.size),
+        "stride": len(pixels) // image.height if image.height else 0
+    }
+    if image.mode == "P":
+        geometry["palette"] = image.getpalette()
+    return geometry, pixels
+
+def unpack_image(geometry, pixels):
+    """Rebuild an image from a geometry dict and a raw pixel buffer"""
+    mode = geometry["mode"]
+    size = tuple(geometry["size"])
+    stride = geometry.get("stride", 0)
+    image = Image.frombuffer(mode, size, pixels, 'raw', mode, stride, 1)
+    if mode == "P" and geometry.get("palette"):
+        image.putpalette(geometry["palette"])
+    return image
+
+# Codecs for the pixel frame of v2 messages, negotiated per endpoint by family.
+# zlib takes a level ("zlib-1" .. "zlib-9"), webp is always lossless, qoi is
+# the QOI format. The image codecs only take these modes and WebP no more than
+# WEBP_MAX_SIZE pixels a side, anything else is sent raw. Availability of webp
+# and qoi depends on how Pillow was built.
+CODEC_IMAGE_MODES = ("L", "RGB", "RGBA")
+AUTO_CODECS = ("raw", "zlib-1", "zlib-6", "webp", "qoi")
+WEBP_MAX_SIZE = 16383
+
+def available_codecs():
+    """Codec families this process can encode and decode"""
+    from PIL import features
+    Image.init()
+    codecs = ["raw", "zlib"]
+    if features.check("webp"):
+        codecs.append("webp")
+    if "QOI" in Image.SAVE and "QOI" in Image.OPEN:
+        codecs.append("qoi")
+    return codecs
+
+def codec_family(codec):
+    return codec.split("-", 1)[0]
+
+def codec_accepts(codec, mode, size):
+    """Check whether codec can hold an image of mode and size, else it is sent raw"""
+    family = codec_family(codec)
+    if family not in ("webp", "qoi"):
+        return True
+    if mode not in CODEC_IMAGE_MODES:
+        return False
+    return family != "webp" or max(size) <= WEBP_MAX_SIZE
+
+def encode_payload(image, codec):
+    """Geometry dict and pixel frame of an image compressed with codec
+
+    The geometry carries the codec name unless the frame is sent raw, which
+    happens for "raw" and for modes the codec can't hold.
+    """
+    family = codec_family(codec)
+    if family in ("webp", "qoi") and codec_accepts(codec, image.mode, image.size):
+        buffer = io.BytesIO()
+        # L is sent as RGB, both formats only store color images
+        source = image.convert('RGB') if image.mode == 'L' else image
+        if family == "webp":
+            # exact keeps the color of fully transparent pixels
+            source.save(buffer, format='WEBP', lossless=True, exact=True, quality=10, method=1)
+        else:
+            source.save(buffer, format='QOI')
+        return {"mode": image.mode, "size": list(image.size), "codec": family}, buffer.getvalue()
+
+    geometry, pixels = pack_image(image)
+    if family == "zlib":
+        level = int(codec.split("-", 1)[1]) if "-" in codec else 1
+        return dict(geometry, codec=f"zlib-{level}"), zlib.compress(pixels, level)
+    return geometry, pixels
+
+def decode_payload(geometry, payload):
+    """Rebuild an image from a geometry dict and a frame made by encode_payload"""
+    family = codec_family(geometry.get("codec") or "raw")
+    if family == "zlib":
+        return unpack_image(geometry, zlib.decompress(payload))
+    if family in ("webp", "qoi"):
+        image = Image.open(io.BytesIO(payload))
+        image.load()
+        if image.mode != geometry["mode"]:
+            image = image.convert(geometry["mode"])
+        return image
+    if family != "raw":
+        raise ValueError(f"Unknown payload codec {geometry.get('codec')}")
+    return unpack_image(geometry, payload)
+
+def image_nbytes(image):
+    """Approximate the memory used by an image's pixels"""
+    bits = {"1": 1, "I;16": 16, "I": 32, "F": 32}.get(image.mode)
+    if bits is None:
+        # PIL stores 3 and 4 band images with 4 bytes per pixel
+        bands = len(image.getbands())
+        bits = 32 if bands >= 3 else 8 * bands
+    return image.width * image.height * bits // 8
+
+def _untrack_segment(segment):
+    # Segments are handed between processes, so stop this process's resource
+    # tracker from unlinking them (or warning about leaks) when it exits
+    if os.name == 'posix':
+        from multiprocessing import resource_tracker
+        try:
+            resource_tracker.unregister(segment._name, "shared_memory")
+        except Exception:
+            pass
+
+def share_image(image, untrack=False):
+    """Copy an image's pixels into a new shared memory segment
+
+    Returns the geometry dict (including the segment name under "shm") and the
+    segment. Pass untrack=True when ownership is handed to another process.
+    """
+    geometry, pixels = pack_image(image)
+    segment = shared_memory.SharedMemory(create=True, size=max(len(pixels), 1))
+    segment.buf[:len(pixels)] = pixels
+    if untrack:
+        _untrack_segment(segment)
+    return dict(geometry, shm=segment.name), segment
+
+def attach_shared_image(geometry):
+    """Map the segment named in geometry and wrap it as an image without copying
+
+    The image is only valid until the returned segment is closed.
+    """
+    segment = shared_memory.SharedMemory(name=geometry["shm"])
+    _untrack_segment(segment)
+    return unpack_image(geometry, segment.buf), segment
+
+def read_shared_image(geometry):
+    """Copy an image out of a shared memory segment and free the segment"""
+    # No untracking here, unlink() below takes care of the resource tracker
+    segment = shared_memory.SharedMemory(name=geometry["shm"])
+    try:
+        mode = geometry["mode"]
+        image = Image.frombytes(mode, tuple(geometry["size"]), segment.buf, 'raw', mode, geometry.get("stride", 0), 1)
+        if mode == "P" and geometry.get("palette"):
+            image.putpalette(geometry["palette"])
+        return image
+    finally:
+        segment.close()
+        segment.unlink()
+
+def _float32(value):
+    # PIL blends in single precision, round the same way to match it exactly
+    return struct.unpack('f', struct.pack('f', value))[0]
+
+class PointOpEngine():
+    """Applies chains of per-pixel point operations with lookup tables
+
+    Brightness, contrast and gamma are composed into one 256 entry table that
+    is applied to every color channel in a single Image.point pass. Grayscale
+    conversions split the chain, since they mix channels. Brightness and
+    contrast tables reproduce ImageEnhance's results exactly.
+    """
+    IDENTITY = tuple(range(256))
+
+    def __init__(self, max_tables=256):
+        self.tables = OrderedDict()
+        self.max_tables = max_tables
+        self.lock = threading.Lock()
+
+    def table(self, operation, value, mean=0):
+        """Return the cached table for one operation"""
+        key = (operation, value, mean)
+        with self.lock:
+            table = self.tables.get(key)
+            if table is not None:
+                self.tables.move_to_end(key)
+                return table
+
+        alpha = _float32(value)
+        if operation == "brightness":
+            # ImageEnhance.Brightness blends with black: v * factor
+            table = tuple(min(255, max(0, int(_float32(alpha * v)))) for v in range(256))
+        elif operation == "contrast":
+            # ImageEnhance.Contrast blends with the mean gray level
+            table = tuple(min(255, max(0, int(_float32(mean + _float32(alpha * (v - mean)))))) for v in range(256))
+        elif operation == "gamma":
+            table = tuple(min(255, int(255 * (v / 255) ** (1 / value) + 0.5)) for v in range(256))
+        else:
+            raise ValueError(f"Unknown point operation: {operation}")
+
+        with self.lock:
+            self.tables[key] = table
+            if len(self.tables) > self.max_tables:
+                self.tables.popitem(last=False)
+        return table
+
+    def gray_mean(self, image, table):
+        """Mean gray level of image after table, as ImageEnhance.Contrast computes it"""
+        if table is self.IDENTITY:
+            return int(ImageStat.Stat(image.convert('L')).mean[0] + 0.5)
+
+        # Avoid materializing the intermediate image, push the histograms
+        # through the table and weight the channels like convert('L') does
+        histogram = image.histogram()
+        bands = 1 if image.mode in ('L', 'LA') else 3
+        weights = (1.0,) if bands == 1 else (0.299, 0.587, 0.114)
+        mean = 0.0
+        for band, weight in enumerate(weights):
+            counts = histogram[band * 256:(band + 1) * 256]
+            total = sum(counts) or 1
+            mean += weight * sum(table[v] * count for v, count in enumerate(counts)) / total
+        return int(mean + 0.5)
+
+    def apply_table(self, image, table):
+        if table is self.IDENTITY:
+            return image
+        if image.mode in ('L', 'RGB'):
+            return image.point(list(table) * len(image.getbands()))
+        # Leave the alpha channel alone
+        return image.point(list(table) * (len(image.getbands()) - 1) + list(self.IDENTITY))
+
+    def apply(self, image, operations):
+        """Apply a list of (operation, value) tuples to image
+
+        Operations are "brightness", "contrast", "gamma" and "grayscale" (whose
+        value is ignored). Grayscale gives an RGB result like the service does.
+        A contrast tuple may carry a third item, the mean gray level to use,
+        otherwise it is measured from the image.
+        """
+        if image.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+
+        table = self.IDENTITY
+        for op in operations:
+            operation, value = op[0], op[1]
+            if operation == "grayscale":
+                image = self.apply_table(image, table).convert('L').convert('RGB')
+                table = self.IDENTITY
+                continue
+
+            mean = 0
+            if operation == "contrast":
+                mean = op[2] if len(op) > 2 and op[2] is not None else self.gray_mean(image, table)
+            step = self.table(operation, value, mean)
+            table = step if table is self.IDENTITY else tuple(step[v] for v in table)
+
+        return self.apply_table(image, table)
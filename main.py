@@ -5,16 +5,1861 @@ from tkinter import messagebox
 from PIL import Image, ImageTk
 import tkinter.simpledialog as simpledialog
 import tkinter.ttk as ttk
-from PIL import Image, ImageTk, ImageEnhance
+from PIL import Image, ImageTk, ImageEnhance, ImageChops, ExifTags
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import uuid
+import sys
+import time
+import argparse
+import math
+import zlib
+import tempfile
 import base64
 from glob import glob
 from dotenv import dotenv_values
 
 import zmq
 import io
+import os
+import threading
+import queue
+import hashlib
+import weakref
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from imaging import (PROTOCOL_JSON, PROTOCOL_BINARY, PROTOCOL_SHM, SUPPORTED_PROTOCOLS,
+                     AUTO_CODECS, pack_image, unpack_image, available_codecs, codec_family,
+                     codec_accepts, encode_payload, decode_payload, image_nbytes, share_image,
+                     read_shared_image, PointOpEngine)
+
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1", "[::1]")
+
+def is_local_endpoint(endpoint):
+    """Check whether a ZMQ endpoint points at a service on this host"""
+    if endpoint.startswith(("ipc://", "inproc://")):
+        return True
+    host = endpoint.split("://", 1)[-1].rsplit(":", 1)[0]
+    return host in LOCAL_HOSTS
+
+class PerfStats():
+    """Per-stage timings of image operations
+
+    An operation's trace is started with begin() and ends with finish(). In
+    between, code on the same thread times its stages with
+    `with perf.stage("encode"):`. Stages outside a trace aren't recorded, so
+    the instrumented code doesn't need to know who called it. A trace can be
+    carried to another thread with resume(). Finished traces are aggregated
+    for stats() and, if a trace file is open, written to it as JSON lines.
+    """
+    def __init__(self, window=500):
+        self.window = window
+        self.samples = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.trace_file = None
+
+    def open_trace(self, path):
+        """Append every finished trace to a JSON-lines file"""
+        self.trace_file = open(path, 'a', buffering=1)
+
+    def begin(self, operation, attach=True, **info):
+        """Start a trace, making it current on this thread unless attach is False"""
+        trace = dict(info, operation=operation, time=time.time(), stages={}, started=time.perf_counter())
+        if attach:
+            self.local.trace = trace
+        return trace
+
+    def resume(self, trace):
+        self.local.trace = trace
+
+    def current(self):
+        return getattr(self.local, 'trace', None)
+
+    @contextmanager
+    def stage(self, name):
+        trace = self.current()
+        if trace is None:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - started) * 1000, trace)
+
+    def add(self, name, ms, trace=None):
+        """Add ms to a stage of the current trace, e.g. time reported by a server"""
+        trace = trace or self.current()
+        if trace is not None:
+            trace["stages"][name] = trace["stages"].get(name, 0.0) + ms
+
+    def finish(self, trace=None):
+        """End a trace, record its stages and return it"""
+        trace = trace or self.current()
+        if trace is None:
+            return None
+        if self.current() is trace:
+            self.local.trace = None
+        trace["total"] = (time.perf_counter() - trace.pop("started")) * 1000
+
+        with self.lock:
+            operation = self.samples.setdefault(trace["operation"], {})
+            for name, ms in list(trace["stages"].items()) + [("total", trace["total"])]:
+                operation.setdefault(name, deque(maxlen=self.window)).append(ms)
+            if self.trace_file is not None:
+                self.trace_file.write(json.dumps(trace) + "\n")
+        return trace
+
+    def stats(self):
+        """Count, mean, p50, p99 and max ms per stage of each operation"""
+        with self.lock:
+            samples = {operation: {name: sorted(values) for name, values in stages.items()}
+                       for operation, stages in self.samples.items()}
+        return {
+            operation: {
+                name: {
+                    "count": len(values),
+                    "mean_ms": sum(values) / len(values),
+                    "p50_ms": values[len(values) // 2],
+                    "p99_ms": values[min(len(values) - 1, int(len(values) * 0.99))],
+                    "max_ms": values[-1]
+                }
+                for name, values in stages.items()
+            }
+            for operation, stages in samples.items()
+        }
+
+    @staticmethod
+    def summary(trace):
+        """One line of a trace's timings for the tip bar"""
+        stages = ", ".join(f"{name} {ms:.0f}" for name, ms in trace["stages"].items())
+        return f"{trace['operation']} {trace['total']:.0f} ms ({stages})"
+
+# Shared by the viewer, the services and batch runs
+perf = PerfStats()
+
+class ServiceClient():
+    """Pooled connections to the ZMQ image services over one shared context
+
+    Every request checks a DEALER socket out of the pool for its endpoint, so
+    several requests (from different threads) can be in flight at once. Retries
+    follow the lazy pirate pattern: when no reply arrives within the timeout the
+    socket is closed, a fresh one is connected and the request is sent again.
+
+    Each request carries an ID frame ahead of the envelope delimiter, which REP
+    and ROUTER servers echo back, so late replies to an earlier attempt are
+    recognized and dropped. The client also tracks the requests in flight and
+    the average latency of every endpoint, see choose().
+    """
+    def __init__(self, timeout=2000, retries=1, pool_size=4):
+        self.context = zmq.Context()
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        self.pools = {}
+        self.load = {}
+        self.lock = threading.Lock()
+
+    def choose(self, endpoints):
+        """Pick the endpoint expected to answer soonest
+
+        The estimate is the average latency times the requests already queued
+        on it plus one. Idle endpoints that haven't answered yet score zero so
+        each gets probed, but only by one request at a time. Timeouts count as
+        a full timeout of latency.
+        """
+        if len(endpoints) == 1:
+            return endpoints[0]
+        with self.lock:
+            def score(endpoint):
+                load = self.load.get(endpoint, {"in_flight": 0, "latency": 0.0})
+                latency = load["latency"] or (math.inf if load["in_flight"] else 0.0)
+                return ((load["in_flight"] + 1) * latency, load["in_flight"])
+            return min(endpoints, key=score)
+
+    def _track(self, endpoint, elapsed=None):
+        # Called with elapsed=None when a request starts, then with its
+        # latency (or the timeout) when it finishes
+        with self.lock:
+            load = self.load.setdefault(endpoint, {"in_flight": 0, "latency": 0.0})
+            if elapsed is None:
+                load["in_flight"] += 1
+                return
+            load["in_flight"] -= 1
+            latency = elapsed * 1000
+            load["latency"] = latency if not load["latency"] else 0.8 * load["latency"] + 0.2 * latency
+
+    def is_connected(self, endpoint):
+        with self.lock:
+            return endpoint in self.pools
+
+    def _checkout(self, endpoint):
+        with self.lock:
+            idle = self.pools.setdefault(endpoint, [])
+            if idle:
+                return idle.pop()
+
+        socket = self.context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(endpoint)
+        return socket
+
+    def _checkin(self, endpoint, socket):
+        with self.lock:
+            idle = self.pools.setdefault(endpoint, [])
+            if len(idle) < self.pool_size:
+                idle.append(socket)
+                return
+        socket.close()
+
+    def request(self, endpoint, frames, timeout=None, retries=None):
+        """Send a multipart request and return the reply frames
+
+        Raises zmq.error.Again if every attempt times out.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        retries = self.retries if retries is None else retries
+
+        for attempt in range(retries + 1):
+            socket = self._checkout(endpoint)
+            request_id = uuid.uuid4().bytes
+            started = time.perf_counter()
+            self._track(endpoint)
+            try:
+                # The empty delimiter frame keeps DEALER compatible with REP servers
+                with perf.stage("send"):
+                    socket.send_multipart([request_id, b""] + list(frames), copy=False)
+                deadline = started + timeout / 1000
+                while True:
+                    remaining = int((deadline - time.perf_counter()) * 1000)
+                    with perf.stage("receive"):
+                        if remaining <= 0 or not socket.poll(remaining, zmq.POLLIN):
+                            break
+                        reply = socket.recv_multipart(copy=False)
+                    if reply[0].bytes != request_id:
+                        print(f"Dropping stale reply from {endpoint}")
+                        continue
+                    self._track(endpoint, time.perf_counter() - started)
+                    self._checkin(endpoint, socket)
+                    return reply[2:]
+            except zmq.ZMQError as e:
+                print(f"ZMQ request error on {endpoint}: {e}")
+
+            # No reply, the socket may still get one later so never reuse it
+            self._track(endpoint, max(timeout / 1000, time.perf_counter() - started))
+            socket.close()
+            if attempt < retries:
+                print(f"No reply from {endpoint}, retrying ({attempt + 1}/{retries})...")
+
+        raise zmq.error.Again(f"No reply from {endpoint}")
+
+    def close(self):
+        with self.lock:
+            pools, self.pools = self.pools, {}
+        for idle in pools.values():
+            for socket in idle:
+                socket.close()
+        self.context.term()
+
+class JobExecutor():
+    """Runs slow work on a thread pool and hands the results back to Tk
+
+    Jobs are grouped by key. Submitting a job under a key that already has one
+    pending supersedes it: the old job is cancelled if it hasn't started yet,
+    otherwise its result is dropped when it finishes. Callbacks always run on
+    the Tk main loop, polled with window.after, since Tk isn't thread safe.
+    """
+    def __init__(self, window, max_workers=2, poll_interval=20):
+        self.window = window
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-job")
+        self.results = queue.Queue()
+        self.current = {}
+        self.next_id = 0
+        self.poll_interval = poll_interval
+        self.polling = False
+
+    def submit(self, key, work, on_done, on_error=None):
+        """Run work() in the background and call on_done(result) on the Tk loop"""
+        if self.cancel(key):
+            print(f"Superseded pending '{key}' job")
+
+        self.next_id += 1
+        job_id = self.next_id
+        future = self.pool.submit(work)
+        self.current[key] = (job_id, future)
+        future.add_done_callback(lambda f: self.results.put((key, job_id, f, on_done, on_error)))
+
+        if not self.polling:
+            self.polling = True
+            self.window.after(self.poll_interval, self._poll)
+        return job_id
+
+    def cancel(self, key):
+        """Cancel the pending job for key, returns True if there was one"""
+        job = self.current.pop(key, None)
+        if job is None:
+            return False
+        job[1].cancel()
+        return True
+
+    def is_busy(self, key):
+        return key in self.current
+
+    def _poll(self):
+        while True:
+            try:
+                key, job_id, future, on_done, on_error = self.results.get_nowait()
+            except queue.Empty:
+                break
+
+            # Ignore jobs that were cancelled or replaced by a newer one
+            job = self.current.get(key)
+            if job is None or job[0] != job_id or future.cancelled():
+                continue
+            del self.current[key]
+
+            try:
+                result = future.result()
+            except Exception as e:
+                if on_error:
+                    self._run_callback(key, on_error, e)
+                else:
+                    print(f"Error in background job '{key}': {e}")
+            else:
+                self._run_callback(key, on_done, result)
+
+        if self.current:
+            self.window.after(self.poll_interval, self._poll)
+        else:
+            self.polling = False
+
+    def _run_callback(self, key, callback, value):
+        # A failing callback must not stop the polling, later results would
+        # never be delivered
+        try:
+            callback(value)
+        except Exception as e:
+            print(f"Error in callback of background job '{key}': {e}")
+
+    def shutdown(self):
+        for key in list(self.current):
+            self.cancel(key)
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+# Keys of the properties dict, 'heigth' is spelled the way the service returns it
+PROPERTY_FIELDS = ('width', 'heigth', 'format', 'color_mode', 'file_size')
+
+class ResultCache():
+    """LRU cache of processed images keyed by the input pixels and operation
+
+    Entries are kept in memory up to max_bytes and the least recently used
+    ones are evicted first. If a cache directory is given, evicted entries
+    are written there as raw pixel files (up to max_disk_bytes) and are found
+    again on a memory miss.
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024, cache_dir=None, max_disk_bytes=1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        # Hashing a large image isn't free, so remember digests per image object.
+        # Images aren't hashable, so they're keyed by id until they're collected
+        self.digests = {}
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def image_digest(self, image):
+        """Hash an image's mode, size and pixels"""
+        with self.lock:
+            digest = self.digests.get(id(image))
+        if digest is None:
+            hasher = hashlib.blake2b(digest_size=16)
+            hasher.update(f"{image.mode}:{image.size}".encode('utf-8'))
+            hasher.update(image.tobytes())
+            digest = hasher.hexdigest()
+            with self.lock:
+                self.digests[id(image)] = digest
+            weakref.finalize(image, self._forget_digest, id(image))
+        return digest
+
+    def _forget_digest(self, image_id):
+        with self.lock:
+            self.digests.pop(image_id, None)
+
+    def make_key(self, image, operation, params):
+        """Build a cache key for applying operation with params to image"""
+        params = json.dumps(params, sort_keys=True)
+        return f"{self.image_digest(image)}-{operation}-{hashlib.sha1(params.encode('utf-8')).hexdigest()}"
+
+    def get(self, key):
+        """Return the cached image for key, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        image = self._load(key)
+        with self.lock:
+            if image is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self.put(key, image)
+        return image
+
+    def put(self, key, image):
+        nbytes = image_nbytes(image)
+        if nbytes > self.max_bytes:
+            return
+
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (image, nbytes)
+            self.size += nbytes
+            while self.size > self.max_bytes:
+                old_key, (old_image, old_nbytes) = self.entries.popitem(last=False)
+                self.size -= old_nbytes
+                self.evictions += 1
+                evicted.append((old_key, old_image))
+
+        # Disk writes happen outside the lock
+        for old_key, old_image in evicted:
+            self._spill(old_key, old_image)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.raw")
+
+    def _spill(self, key, image):
+        if not self.cache_dir:
+            return
+        try:
+            geometry, pixels = pack_image(image)
+            with open(self._path(key), 'wb') as cache_file:
+                cache_file.write(json.dumps(geometry).encode('utf-8') + b"\n")
+                cache_file.write(pixels)
+            self._trim_disk()
+        except Exception as e:
+            print(f"Could not write cache entry to disk: {e}")
+
+    def _load(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._path(key), 'rb') as cache_file:
+                geometry = json.loads(cache_file.readline())
+                pixels = cache_file.read()
+            os.utime(self._path(key))
+            return unpack_image(geometry, pixels)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Could not read cache entry from disk: {e}")
+            return None
+
+    def _trim_disk(self):
+        # Remove the least recently used files once the disk budget is exceeded
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".raw"):
+                path = os.path.join(self.cache_dir, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size
+            }
+
+class DisplayPyramid():
+    """Successively halved copies of an image used to scale it for display
+
+    Levels are built on demand with Image.reduce, so scaling the view only
+    has to resample from the nearest level that is still large enough.
+    """
+    # Modes Image.reduce can't handle are converted for the smaller levels
+    REDUCE_MODES = ("L", "LA", "RGB", "RGBA", "RGBX", "CMYK", "I", "F")
+
+    def __init__(self, image, min_size=64):
+        self.source = image
+        self.levels = [image]
+        self.min_size = min_size
+
+    def level_for(self, width, height):
+        """Return the smallest level that is at least width x height"""
+        while True:
+            level = self.levels[-1]
+            if level.width // 2 < max(width, self.min_size) or level.height // 2 < max(height, self.min_size):
+                break
+            if level.mode not in self.REDUCE_MODES:
+                level = level.convert('RGBA' if 'A' in level.getbands() or 'transparency' in level.info else 'RGB')
+            self.levels.append(level.reduce(2))
+
+        for level in reversed(self.levels):
+            if level.width >= width and level.height >= height:
+                return level
+        return self.levels[0]
+
+def exif_thumbnail(image):
+    """The thumbnail embedded in an opened image's EXIF data, or None
+
+    Only reads the header, the image's pixels are not decoded. Thumbnails
+    that don't have the image's aspect ratio are letterboxed and skipped.
+    """
+    if image.format != 'JPEG':
+        # Other formats may need a full decode to find their EXIF data (PNG)
+        return None
+    try:
+        thumbnail = image.getexif().get_ifd(ExifTags.IFD.IFD1)
+        offset, length = thumbnail.get(0x0201), thumbnail.get(0x0202)
+        exif = image.info.get("exif")
+        if not offset or not length or not exif:
+            return None
+        # Offsets count from the TIFF header, after JPEG's "Exif" marker
+        start = 6 if exif.startswith(b"Exif\x00\x00") else 0
+        preview = Image.open(io.BytesIO(exif[start + offset:start + offset + length]))
+        preview.load()
+    except Exception:
+        return None
+    if abs(preview.width * image.height - image.width * preview.height) > 0.02 * image.width * preview.height:
+        return None
+    return preview
+
+def draft_image(file_path, max_width, max_height):
+    """Decode a JPEG at the smallest 1/2, 1/4 or 1/8 scale still covering max_width x max_height
+
+    Returns None for formats that can't decode at a reduced scale.
+    """
+    image = Image.open(file_path)
+    if image.format != 'JPEG' or image.draft(image.mode, (max_width, max_height)) is None:
+        image.close()
+        return None
+    image.load()
+    return image
+
+class EditGraph():
+    """Non-destructive list of edits applied lazily to a source image
+
+    Adding an edit doesn't compute anything. Before rendering, the edits are
+    planned: crops are moved ahead of point operations and folded into the
+    resample region of a preceding resize, so the expensive steps only touch
+    pixels that survive, and runs of point operations are fused into one
+    lookup table pass. Previews render from a reduced copy of the source, so
+    only render() ever works at full resolution.
+
+    Edits are tuples: ("crop", (left, top, right, bottom)), ("resize", (width,
+    height)), ("brightness", factor), ("contrast", factor, mean),
+    ("gamma", gamma) and ("grayscale", None).
+    """
+    POINT_OPS = ("brightness", "contrast", "gamma", "grayscale")
+
+    def __init__(self, source, point_ops):
+        self.source = source
+        self.point_ops = point_ops
+        self.ops = []
+        self._rendered = None
+        self._preview = None
+
+    def push(self, *operation):
+        self.ops.append(tuple(operation))
+        self._rendered = None
+        self._preview = None
+
+    def pop(self):
+        operation = self.ops.pop()
+        self._rendered = None
+        self._preview = None
+        return operation
+
+    def copy(self):
+        """A graph with the same source and edits, e.g. to render on another thread"""
+        graph = EditGraph(self.source, self.point_ops)
+        graph.ops = list(self.ops)
+        return graph
+
+    def size(self):
+        """Size of the rendered result, without rendering it"""
+        width, height = self.source.size
+        for operation in self.ops:
+            if operation[0] == "crop":
+                left, top, right, bottom = operation[1]
+                width, height = right - left, bottom - top
+            elif operation[0] == "resize":
+                width, height = operation[1]
+        return width, height
+
+    def plan(self):
+        """Return the optimized steps that produce the edited image"""
+        steps = []
+        width, height = self.source.size
+        for operation in self.ops:
+            if operation[0] == "resize":
+                # Resizes carry the region of their input they resample from.
+                # A crop before one stays a crop, LANCZOS would otherwise
+                # sample the cropped away pixels around the region
+                steps.append(("resize", tuple(operation[1]), (0, 0, width, height)))
+                width, height = operation[1]
+            elif operation[0] == "crop":
+                left, top, right, bottom = operation[1]
+                width, height = right - left, bottom - top
+                self._push_crop(steps, operation[1])
+            else:
+                steps.append(operation)
+
+        steps = self._tighten_resizes(steps)
+
+        # Fuse runs of point operations into a single step
+        fused = []
+        for step in steps:
+            if step[0] in self.POINT_OPS:
+                if fused and fused[-1][0] == "points":
+                    fused[-1] = ("points", fused[-1][1] + [step])
+                else:
+                    fused.append(("points", [step]))
+            else:
+                fused.append(step)
+        return fused
+
+    def _push_crop(self, steps, box):
+        # Point operations don't care where pixels are, so crop before them
+        i = len(steps)
+        while i > 0 and steps[i - 1][0] in self.POINT_OPS:
+            i -= 1
+
+        if i > 0 and steps[i - 1][0] == "crop":
+            prev_left, prev_top = steps[i - 1][1][:2]
+            steps[i - 1] = ("crop", (prev_left + box[0], prev_top + box[1], prev_left + box[2], prev_top + box[3]))
+        elif i > 0 and steps[i - 1][0] == "resize":
+            # Only resample the part of the input that survives the crop
+            (width, height), (x0, y0, x1, y1) = steps[i - 1][1], steps[i - 1][2]
+            sx = (x1 - x0) / width
+            sy = (y1 - y0) / height
+            region = (x0 + box[0] * sx, y0 + box[1] * sy, x0 + box[2] * sx, y0 + box[3] * sy)
+            steps[i - 1] = ("resize", (box[2] - box[0], box[3] - box[1]), region)
+        else:
+            steps.insert(i, ("crop", tuple(box)))
+
+    def _tighten_resizes(self, steps):
+        # A resize that only samples part of its input (because a later crop
+        # was folded into it) gets a crop in front of the point operations
+        # feeding it, keeping enough margin for the LANCZOS filter support.
+        # The margin stays inside the input, so it never reaches past an
+        # earlier crop
+        tightened = []
+        width, height = self.source.size
+        for step in steps:
+            if step[0] == "crop":
+                left, top, right, bottom = step[1]
+                width, height = right - left, bottom - top
+                tightened.append(step)
+                continue
+            if step[0] != "resize":
+                tightened.append(step)
+                continue
+
+            (out_width, out_height), (x0, y0, x1, y1) = step[1], step[2]
+            margin_x = 3 * max(1.0, (x1 - x0) / out_width) + 1
+            margin_y = 3 * max(1.0, (y1 - y0) / out_height) + 1
+            region = (
+                max(0, math.floor(x0 - margin_x)),
+                max(0, math.floor(y0 - margin_y)),
+                min(width, math.ceil(x1 + margin_x)),
+                min(height, math.ceil(y1 + margin_y))
+            )
+            if region != (0, 0, width, height):
+                i = len(tightened)
+                while i > 0 and tightened[i - 1][0] in self.POINT_OPS:
+                    i -= 1
+                if i > 0 and tightened[i - 1][0] == "crop":
+                    prev_left, prev_top = tightened[i - 1][1][:2]
+                    tightened[i - 1] = ("crop", (prev_left + region[0], prev_top + region[1],
+                                                 prev_left + region[2], prev_top + region[3]))
+                else:
+                    tightened.insert(i, ("crop", region))
+                step = ("resize", (out_width, out_height),
+                        (x0 - region[0], y0 - region[1], x1 - region[0], y1 - region[1]))
+
+            tightened.append(step)
+            width, height = out_width, out_height
+        return tightened
+
+    def _run(self, plan, image, scale, output_scale):
+        # image is the source scaled by scale, resizes produce output_scale
+        # times their nominal size
+        for step in plan:
+            if step[0] == "crop":
+                image = image.crop(tuple(int(round(v * scale)) for v in step[1]))
+            elif step[0] == "resize":
+                (width, height), box = step[1], step[2]
+                size = (max(1, round(width * output_scale)), max(1, round(height * output_scale)))
+                image = image.resize(size, Image.Resampling.LANCZOS, box=tuple(v * scale for v in box))
+                scale = output_scale
+            else:
+                image = self.point_ops.apply(image, step[1])
+        return image
+
+    def render(self, runner=None):
+        """Render the edits at full resolution, cached until the edits change
+
+        runner(source, ops, render_locally) can render the edits somewhere
+        else, falling back to render_locally(source).
+        """
+        if not self.ops:
+            return self.source
+        if self._rendered is None:
+            render_locally = lambda image: self._run(self.plan(), image, 1.0, 1.0)
+            if runner is None:
+                self._rendered = render_locally(self.source)
+            else:
+                self._rendered = runner(self.source, list(self.ops), render_locally)
+        return self._rendered
+
+    def render_preview(self, max_width, max_height, pyramid=None):
+        """Render the edits at roughly the size needed to fill max_width x max_height
+
+        With a DisplayPyramid of the source, rendering starts from the smallest
+        level that still has enough pixels.
+        """
+        key = (max_width, max_height)
+        if self._preview is not None and self._preview[0] == key:
+            return self._preview[1]
+        if not self.ops and pyramid is None:
+            return self.source
+
+        width, height = self.size()
+        output_scale = min(1.0, max_width / width, max_height / height)
+        plan = self.plan()
+
+        # Up to the first resize the pipeline works at source scale
+        source_scale = output_scale
+        for step in plan:
+            if step[0] == "resize":
+                (step_width, step_height), box = step[1], step[2]
+                source_scale = output_scale * max(step_width / (box[2] - box[0]), step_height / (box[3] - box[1]))
+                break
+        source_scale = min(1.0, source_scale)
+
+        source = self.source
+        if pyramid is not None:
+            source = pyramid.level_for(int(self.source.width * source_scale + 1), int(self.source.height * source_scale + 1))
+        image = self._run(plan, source, source.width / self.source.width, output_scale)
+
+        self._preview = (key, image)
+        return image
+
+class EditHistory():
+    """Undo/redo stack for the edit graph with bounded memory use
+
+    Edits recorded in the graph are undone and redone by replaying their
+    operation. When the graph's source image is replaced (service results,
+    reverting) only the tiles that changed are kept, zlib compressed, or the
+    whole images if their size or mode differ. Once the compressed data goes
+    over max_bytes the oldest of it is moved to a temporary file, and entries
+    beyond max_steps are dropped. The file is rewritten without the data of
+    dropped entries once that is more than half of it.
+
+    make_replace only compresses, it can run on a worker thread and its
+    entry be recorded later with add().
+    """
+    def __init__(self, max_bytes=128 * 1024 * 1024, max_steps=50, tile_size=256):
+        self.max_bytes = max_bytes
+        self.max_steps = max_steps
+        self.tile_size = tile_size
+        self.undo_stack = []
+        self.redo_stack = []
+        self.memory_bytes = 0
+        self.spill_file = None
+        self.spill_bytes = 0
+        self.dead_bytes = 0
+
+    def can_undo(self):
+        return bool(self.undo_stack)
+
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    def clear(self):
+        self.undo_stack = []
+        self.redo_stack = []
+        self.memory_bytes = 0
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+        self.spill_bytes = 0
+        self.dead_bytes = 0
+
+    def record_push(self, operation):
+        """Record an operation pushed onto the edit graph"""
+        self._record({"type": "push", "operation": operation})
+
+    def record_replace(self, before_source, before_ops, after_source, after_ops):
+        """Record the edit graph being replaced by a new source and edits"""
+        self.add(self.make_replace(before_source, before_ops, after_source, after_ops))
+
+    def make_replace(self, before_source, before_ops, after_source, after_ops):
+        """Build the entry for a replace without recording it, see add"""
+        entry = {
+            "type": "replace",
+            "before_ops": tuple(before_ops),
+            "after_ops": tuple(after_ops),
+            "same_source": before_source is after_source
+        }
+        if not entry["same_source"]:
+            if before_source.size == after_source.size and before_source.mode == after_source.mode:
+                entry["before_tiles"], entry["after_tiles"] = self._diff_tiles(before_source, after_source)
+            else:
+                entry["before_image"] = self._store_image(before_source)
+                entry["after_image"] = self._store_image(after_source)
+        return entry
+
+    def add(self, entry):
+        """Record an entry built by make_replace"""
+        self.memory_bytes += sum(blob[2] for blob in self._blobs(entry))
+        self._record(entry)
+
+    def undo(self, graph):
+        """Return the edit graph as it was before the last recorded edit"""
+        entry = self.undo_stack.pop()
+        self.redo_stack.append(entry)
+        if entry["type"] == "push":
+            graph.pop()
+            return graph
+        return self._rebuild(graph, entry, "before")
+
+    def redo(self, graph):
+        """Return the edit graph with the last undone edit applied again"""
+        entry = self.redo_stack.pop()
+        self.undo_stack.append(entry)
+        if entry["type"] == "push":
+            graph.push(*entry["operation"])
+            return graph
+        return self._rebuild(graph, entry, "after")
+
+    def _record(self, entry):
+        # A new edit makes the redo stack meaningless
+        for dropped in self.redo_stack:
+            self._release(dropped)
+        self.redo_stack = []
+
+        self.undo_stack.append(entry)
+        while len(self.undo_stack) > self.max_steps:
+            self._release(self.undo_stack.pop(0))
+        self._enforce_budget()
+        if self.dead_bytes > self.spill_bytes / 2:
+            self._compact_spill()
+
+    def _rebuild(self, graph, entry, side):
+        if entry["same_source"]:
+            source = graph.source
+        elif f"{side}_image" in entry:
+            source = self._load_image(entry[f"{side}_image"])
+        else:
+            source = graph.source.copy()
+            for box, blob in entry[f"{side}_tiles"]:
+                tile = Image.frombytes(source.mode, (box[2] - box[0], box[3] - box[1]), self._load(blob))
+                source.paste(tile, box)
+
+        rebuilt = EditGraph(source, graph.point_ops)
+        for operation in entry[f"{side}_ops"]:
+            rebuilt.push(*operation)
+        return rebuilt
+
+    def _diff_tiles(self, before, after):
+        # Keep only the tiles that actually changed, in both versions
+        before_tiles = []
+        after_tiles = []
+        step = self.tile_size
+        for top in range(0, before.height, step):
+            for left in range(0, before.width, step):
+                box = (left, top, min(left + step, before.width), min(top + step, before.height))
+                old_tile = before.crop(box)
+                new_tile = after.crop(box)
+                if ImageChops.difference(old_tile, new_tile).getbbox() is None:
+                    continue
+                before_tiles.append((box, self._store(old_tile.tobytes())))
+                after_tiles.append((box, self._store(new_tile.tobytes())))
+        return before_tiles, after_tiles
+
+    def _store_image(self, image):
+        geometry, pixels = pack_image(image)
+        return geometry, self._store(pixels)
+
+    def _load_image(self, stored):
+        geometry, blob = stored
+        return unpack_image(geometry, self._load(blob))
+
+    def _store(self, data):
+        # Blobs are [compressed bytes or None, file offset, length] so they
+        # can be moved to the spill file in place. Memory is counted by add()
+        compressed = zlib.compress(data, 1)
+        return [compressed, None, len(compressed)]
+
+    def _load(self, blob):
+        if blob[0] is not None:
+            return zlib.decompress(blob[0])
+        self.spill_file.seek(blob[1])
+        return zlib.decompress(self.spill_file.read(blob[2]))
+
+    def _blobs(self, entry):
+        for key in ("before_tiles", "after_tiles"):
+            for _, blob in entry.get(key, ()):
+                yield blob
+        for key in ("before_image", "after_image"):
+            if key in entry:
+                yield entry[key][1]
+
+    def _release(self, entry):
+        for blob in self._blobs(entry):
+            if blob[0] is not None:
+                self.memory_bytes -= blob[2]
+                blob[0] = None
+            elif blob[1] is not None:
+                # Dead space in the spill file until it is compacted
+                self.dead_bytes += blob[2]
+                blob[1] = None
+
+    def _compact_spill(self):
+        """Rewrite the spill file with only the blobs still in the history"""
+        compacted = tempfile.TemporaryFile(prefix="image-history-")
+        for entry in self.undo_stack + self.redo_stack:
+            for blob in self._blobs(entry):
+                if blob[0] is None and blob[1] is not None:
+                    self.spill_file.seek(blob[1])
+                    data = self.spill_file.read(blob[2])
+                    blob[1] = compacted.tell()
+                    compacted.write(data)
+        self.spill_file.close()
+        self.spill_file = compacted
+        self.spill_bytes = compacted.tell()
+        self.dead_bytes = 0
+
+    def _enforce_budget(self):
+        if self.memory_bytes <= self.max_bytes:
+            return
+        # Oldest undo steps first, then the redo steps furthest away
+        for entry in self.undo_stack + self.redo_stack:
+            for blob in self._blobs(entry):
+                if blob[0] is None:
+                    continue
+                if self.spill_file is None:
+                    self.spill_file = tempfile.TemporaryFile(prefix="image-history-")
+                self.spill_file.seek(0, os.SEEK_END)
+                blob[1] = self.spill_file.tell()
+                self.spill_file.write(blob[0])
+                self.spill_bytes += blob[2]
+                self.memory_bytes -= blob[2]
+                blob[0] = None
+                if self.memory_bytes <= self.max_bytes:
+                    return
+
+class LatencyModel():
+    """Learns how long an operation takes as a function of its pixel count
+
+    Fits seconds = fixed + per_pixel * pixels by least squares over
+    exponentially decayed sums, so it follows a service that gets faster or
+    slower. With samples of only one size it assumes cost is proportional.
+    """
+    def __init__(self, decay=0.95):
+        self.decay = decay
+        self.samples = 0
+        self.weight = self.sum_x = self.sum_y = self.sum_xx = self.sum_xy = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, pixels, seconds):
+        with self.lock:
+            self.samples += 1
+            self.weight = self.weight * self.decay + 1
+            self.sum_x = self.sum_x * self.decay + pixels
+            self.sum_y = self.sum_y * self.decay + seconds
+            self.sum_xx = self.sum_xx * self.decay + pixels * pixels
+            self.sum_xy = self.sum_xy * self.decay + pixels * seconds
+
+    def predict(self, pixels):
+        """Predicted seconds for pixels, or None before the first sample"""
+        with self.lock:
+            if not self.samples:
+                return None
+            mean_x = self.sum_x / self.weight
+            mean_y = self.sum_y / self.weight
+            variance = self.sum_xx / self.weight - mean_x * mean_x
+            if variance <= (0.01 * mean_x) ** 2:
+                return mean_y * pixels / mean_x if mean_x else mean_y
+            per_pixel = max(0.0, (self.sum_xy / self.weight - mean_x * mean_y) / variance)
+            fixed = max(0.0, mean_y - per_pixel * mean_x)
+            return fixed + per_pixel * pixels
+
+class ImageServices():
+    """The grayscale, scaling and adjustments ZMQ services
+
+    Shared by the viewer and batch processing. Endpoints and timeouts come
+    from the config, the wire protocol is negotiated with each endpoint on
+    first use. A service can list several comma separated endpoints (e.g.
+    SCALING_ENDPOINT=tcp://host1:5556,tcp://host2:5556), requests then go to
+    the least loaded one and move on to the next if it doesn't answer.
+    Pixel frames are compressed with a codec picked from the measured speed
+    of each endpoint's link, see choose_codec.
+    """
+    # Starting guesses of codec speed (MB/s, averaged over encode and decode)
+    # and compressed size ratio on photos, replaced by measurements as codecs
+    # get used. Pillow's QOI encoder is slow despite the format's design
+    CODEC_PRIORS = {"zlib-1": (60, 0.6), "zlib-6": (40, 0.53), "webp": (25, 0.3), "qoi": (5, 0.85)}
+    # Smaller round trips are dominated by latency, not link speed
+    LINK_SAMPLE_BYTES = 256 * 1024
+    # While local processing is predicted to be faster, every Nth request
+    # still goes to the service so its latency model stays current
+    REMOTE_PROBE_INTERVAL = 20
+
+    def __init__(self, config):
+        grayscale = f"tcp://{config.get('ZMQ_HOST') or 'localhost'}:{config.get('ZMQ_PORT') or '5555'}"
+        self.endpoints = {
+            "grayscale": self.parse_endpoints(config.get('GRAYSCALE_ENDPOINT') or grayscale),
+            "scaling": self.parse_endpoints(config.get('SCALING_ENDPOINT') or "tcp://localhost:5556"),
+            "adjustments": self.parse_endpoints(config.get('ADJUSTMENTS_ENDPOINT') or "tcp://localhost:5557")
+        }
+
+        # All services share one pooled client
+        self.client = ServiceClient(
+            timeout=int(config.get('ZMQ_TIMEOUT_MS') or 2000),
+            retries=int(config.get('ZMQ_RETRIES') or 1),
+            pool_size=int(config.get('ZMQ_POOL_SIZE') or 4)
+        )
+        self.timeouts = {
+            "grayscale": int(config.get('GRAYSCALE_TIMEOUT_MS') or 2000),
+            "scaling": int(config.get('SCALING_TIMEOUT_MS') or 3000),
+            "adjustments": int(config.get('ADJUSTMENTS_TIMEOUT_MS') or 2000)
+        }
+
+        # Wire protocol and commands negotiated with each endpoint, see
+        # negotiate_protocol
+        self.protocols = {}
+        self.capabilities = {}
+
+        # Payload codecs negotiated with each endpoint, the measured link
+        # speed (bytes/s) of each endpoint and the seconds per byte, size
+        # ratio and sample count of each codec, see choose_codec. PAYLOAD_CODEC
+        # or <SERVICE>_CODEC (e.g. SCALING_CODEC=zlib-9) force a codec
+        self.codecs = {}
+        self.codec_setting = {
+            service: config.get(f'{service.upper()}_CODEC') or config.get('PAYLOAD_CODEC') or "auto"
+            for service in self.endpoints
+        }
+        self.link_speed = {}
+        self.codec_cost = {codec: [1 / (speed * 1000000), ratio, 0] for codec, (speed, ratio) in self.CODEC_PRIORS.items()}
+        self.codec_count = 0
+
+        # Service that runs chained edits, see process_chain
+        self.pipeline_service = config.get('PIPELINE_SERVICE') or "scaling"
+
+        # Images kept on the session service, see process_in_session. Maps
+        # session IDs to the endpoint holding them and the image they hold
+        self.session_service = config.get('SESSION_SERVICE') or self.pipeline_service
+        self.sessions = {}
+
+        # Latency models per (command, "remote" or "local") and per service
+        # failure backoff, see choose_route
+        self.adaptive = config.get('ADAPTIVE_ROUTING', '1') not in ('0', 'false', 'False')
+        self.max_timeout = int(config.get('MAX_TIMEOUT_MS') or 30000)
+        self.latency = {}
+        self.health = {}
+        self.route_count = 0
+        self.local_runs = {}
+
+        # Images above the threshold are sent as tiles, see process_tiled
+        self.tile_threshold = int(float(config.get('TILE_THRESHOLD_MP') or 16) * 1000000)
+        self.tile_size = int(config.get('TILE_SIZE') or 1024)
+        self.tile_pool = ThreadPoolExecutor(max_workers=int(config.get('TILE_WORKERS') or 4))
+        # Measures the global mean gray level of a tiled contrast
+        self.point_ops = PointOpEngine()
+
+    @staticmethod
+    def parse_endpoints(value):
+        return [endpoint.strip() for endpoint in value.split(',') if endpoint.strip()]
+
+    def negotiate_protocol(self, endpoint):
+        """Ask an endpoint which wire protocol it speaks, remembering the answer"""
+        if endpoint in self.protocols:
+            return self.protocols[endpoint]
+
+        protocol = PROTOCOL_JSON
+        offered = list(SUPPORTED_PROTOCOLS)
+        if is_local_endpoint(endpoint):
+            offered.insert(0, PROTOCOL_SHM)
+
+        try:
+            hello = json.dumps({"command": "hello", "protocols": offered, "codecs": available_codecs()}).encode('utf-8')
+            reply = self.client.request(endpoint, [hello], timeout=1000, retries=0)
+            response = json.loads(reply[0].bytes)
+            if response.get("status") == "success" and response.get("protocol") in offered:
+                protocol = response["protocol"]
+                self.capabilities[endpoint] = set(response.get("commands") or ())
+                self.codecs[endpoint] = set(response.get("codecs") or ["raw"]) & set(available_codecs())
+        except zmq.error.Again:
+            # Nothing is listening, don't remember a protocol for it
+            print(f"No reply from {endpoint} to protocol negotiation")
+            raise
+        except Exception as e:
+            print(f"Protocol negotiation error: {e}")
+
+        print(f"Using wire protocol v{protocol} for {endpoint}")
+        self.protocols[endpoint] = protocol
+        return protocol
+
+    def request_image(self, service, request, image, image_format='PNG', timeout=None):
+        """Send an image to a service and wait for the processed image
+
+        Returns the response dict and the returned image, which is None unless
+        the request succeeded. Raises zmq.error.Again if no endpoint of the
+        service answers.
+        """
+        endpoints = self.endpoints[service]
+        untried = list(endpoints)
+        while True:
+            endpoint = self.client.choose(untried)
+            try:
+                return self.request_endpoint(endpoint, service, request, image, image_format, timeout)
+            except zmq.error.Again:
+                untried.remove(endpoint)
+                if not untried:
+                    raise
+                print(f"No reply from {endpoint}, trying another {service} endpoint")
+
+    def request_endpoint(self, endpoint, service, request, image, image_format='PNG', timeout=None):
+        """Send an image to one endpoint of a service, see request_image
+
+        image may be None for requests that only carry parameters.
+        """
+        protocol = self.negotiate_protocol(endpoint)
+        timeout = timeout or self.timeouts.get(service)
+
+        try:
+            if protocol == PROTOCOL_SHM:
+                # Only the segment names and geometry cross the socket, the
+                # service writes its result into a segment of its own
+                geometry, segment = {}, None
+                if image is not None:
+                    with perf.stage("encode"):
+                        geometry, segment = share_image(image)
+                try:
+                    header = dict(request, version=PROTOCOL_SHM, **geometry)
+                    frames = self.client.request(endpoint, [json.dumps(header).encode('utf-8')], timeout)
+                    response = self.read_response(frames)
+                finally:
+                    if segment is not None:
+                        segment.close()
+                        segment.unlink()
+                if response.get("status") == "success" and response.get("shm"):
+                    with perf.stage("decode"):
+                        return response, read_shared_image(response)
+                return response, None
+
+            if protocol == PROTOCOL_BINARY:
+                # Header frame followed by the pixels, raw or compressed with a
+                # codec suited to the link, no PNG or base64 step. The reply
+                # comes back in the same codec
+                geometry, pixel_frames = {}, []
+                if image is not None:
+                    raw_bytes = image.width * image.height * len(image.getbands())
+                    codec = self.choose_codec(endpoint, service, image.mode, image.size)
+                    with perf.stage("encode"):
+                        started = time.perf_counter()
+                        geometry, payload = encode_payload(image, codec)
+                        pixel_frames = [payload]
+                    self.record_codec(geometry.get("codec"), raw_bytes, len(payload), time.perf_counter() - started)
+                else:
+                    # Size unknown, a result too large for the codec comes back raw
+                    codec = self.choose_codec(endpoint, service, "RGB", (0, 0))
+                header = dict(request, version=PROTOCOL_BINARY, reply_codec=codec, **geometry)
+
+                started = time.perf_counter()
+                frames = self.client.request(endpoint, [json.dumps(header).encode('utf-8')] + pixel_frames, timeout)
+                elapsed = time.perf_counter() - started
+                response = self.read_response(frames)
+                wire_bytes = sum(len(frame) for frame in pixel_frames + frames)
+                self.record_link(endpoint, wire_bytes, elapsed - (response.get("server_ms") or 0) / 1000)
+
+                if response.get("status") == "success" and len(frames) > 1:
+                    with perf.stage("decode"):
+                        started = time.perf_counter()
+                        result_image = decode_payload(response, frames[1].buffer)
+                    raw_bytes = result_image.width * result_image.height * len(result_image.getbands())
+                    self.record_codec(response.get("codec"), raw_bytes, len(frames[1]), time.perf_counter() - started)
+                    return response, result_image
+                return response, None
+
+            # Older servers only understand the JSON + base64 PNG format
+            if image is not None:
+                with perf.stage("encode"):
+                    buffer = io.BytesIO()
+                    image.save(buffer, format=image_format)
+                with perf.stage("base64"):
+                    request = dict(request, image=base64.b64encode(buffer.getvalue()).decode('utf-8'))
+            message = json.dumps(request).encode('utf-8')
+            frames = self.client.request(endpoint, [message], timeout)
+
+            response = self.read_response(frames)
+            if response.get("status") == "success" and response.get("image"):
+                with perf.stage("base64"):
+                    img_data = base64.b64decode(response.get("image"))
+                with perf.stage("decode"):
+                    result_image = Image.open(io.BytesIO(img_data))
+                    result_image.load()
+                return response, result_image
+            return response, None
+        except zmq.error.Again:
+            # The service may have been restarted, so negotiate again next time
+            self.protocols.pop(endpoint, None)
+            raise
+
+    def choose_codec(self, endpoint, service, mode, size):
+        """Pick the payload codec for an image of mode and size sent to endpoint
+
+        Minimizes the predicted encode and decode time plus transfer time at
+        the endpoint's measured link speed, so fast links get raw frames and
+        slow ones the tighter codecs. Until the link has been measured remote
+        endpoints get zlib-1 and local ones raw.
+        """
+        offered = self.codecs.get(endpoint, {"raw"})
+        setting = self.codec_setting.get(service, "auto")
+        if setting != "auto":
+            return setting if codec_family(setting) in offered else "raw"
+
+        speed = self.link_speed.get(endpoint)
+        if speed is None:
+            return "zlib-1" if "zlib" in offered and not is_local_endpoint(endpoint) else "raw"
+
+        def cost(codec):
+            if codec == "raw":
+                return 1 / speed
+            seconds_per_byte, ratio, _ = self.codec_cost[codec]
+            return 2 * seconds_per_byte + ratio / speed
+
+        # WebP can't encode images over 16383 pixels a side
+        candidates = [codec for codec in AUTO_CODECS
+                      if codec_family(codec) in offered and codec_accepts(codec, mode, size)]
+        best = min(candidates, key=cost)
+        self.codec_count += 1
+        if self.codec_count % 16 == 0 and not is_local_endpoint(endpoint):
+            # Now and then use the least measured codec that might be close,
+            # so a bad starting guess or a change in speed doesn't go unnoticed
+            close = [codec for codec in candidates if codec != "raw" and cost(codec) < 2 * cost(best)]
+            if close:
+                return min(close, key=lambda codec: self.codec_cost[codec][2])
+        return best
+
+    def record_codec(self, codec, raw_bytes, payload_bytes, seconds):
+        """Learn a codec's speed and ratio from one encode or decode"""
+        cost = self.codec_cost.get(codec)
+        if cost is None or not raw_bytes:
+            return
+        seconds_per_byte, ratio = seconds / raw_bytes, payload_bytes / raw_bytes
+        if cost[2]:
+            seconds_per_byte = 0.7 * cost[0] + 0.3 * seconds_per_byte
+            ratio = 0.7 * cost[1] + 0.3 * ratio
+        cost[:] = [seconds_per_byte, ratio, cost[2] + 1]
+
+    def record_link(self, endpoint, wire_bytes, seconds):
+        """Learn an endpoint's link speed from the bytes and network time of a round trip"""
+        if wire_bytes < self.LINK_SAMPLE_BYTES or seconds <= 0:
+            return
+        speed = wire_bytes / seconds
+        previous = self.link_speed.get(endpoint)
+        self.link_speed[endpoint] = speed if previous is None else 0.7 * previous + 0.3 * speed
+
+    @staticmethod
+    def read_response(frames):
+        # Servers may report how long they spent on the request
+        response = json.loads(frames[0].bytes)
+        if isinstance(response.get("server_ms"), (int, float)):
+            perf.add("server", response["server_ms"])
+        return response
+
+    def process(self, service, request, image, local_operation, image_format='PNG', tiled=True):
+        """Run a request on a service, falling back to local_operation(image)
+
+        Images larger than the tile threshold go through process_tiled. When
+        local processing is predicted to be faster, or the service has been
+        failing, the service is skipped. Safe to call from worker threads.
+        """
+        command = request["command"]
+        if tiled and image.width * image.height > self.tile_threshold:
+            result_image = self.process_tiled(service, request, image, local_operation, image_format)
+            if result_image is not None:
+                return result_image
+
+        pixels = self.work_pixels(request, image)
+        if self.choose_route(service, command, pixels) == "local":
+            return self.process_locally(command, pixels, image, local_operation)
+
+        timeout = self.timeout_for(service, command, pixels)
+        try:
+            # Send request
+            print(f"Sending {command} request to ZMQ server...")
+
+            try:
+                # Send the image and receive response
+                started = time.perf_counter()
+                response, result_image = self.request_image(service, request, image, image_format, timeout)
+                self.record_remote(service, command, pixels, time.perf_counter() - started)
+
+                if response.get("status") == "success":
+                    print(f"Successfully processed {command} via ZMQ")
+                    return result_image
+
+                # Fall back to local processing
+                print(f"ZMQ server error: {response.get('error')}")
+            except zmq.error.Again:
+                # Timeout - fall back to local processing
+                print("ZMQ timeout - using local processing")
+                self.record_remote(service, command, pixels, None, timeout)
+        except Exception as e:
+            # Any other error - use local processing
+            print(f"Error in {command} processing: {e}")
+
+        return self.process_locally(command, pixels, image, local_operation)
+
+    def supports(self, service, command):
+        """Check whether every endpoint of a service advertised command"""
+        health = self.health.get(service)
+        if health and time.monotonic() < health["retry_at"]:
+            return False
+        try:
+            for endpoint in self.endpoints[service]:
+                self.negotiate_protocol(endpoint)
+        except zmq.error.Again:
+            return False
+        return all(command in self.capabilities.get(endpoint, ()) for endpoint in self.endpoints[service])
+
+    def process_chain(self, operations, image, point_ops, local_operation=None, image_format='PNG'):
+        """Apply a list of edit tuples with a single pipeline request
+
+        The image goes up once and only the final result comes back. Services
+        without the pipeline command get one request per edit instead.
+        local_operation(image) is the fallback for the whole chain, by default
+        the edits are applied locally one after the other. Raises ValueError
+        for edits the services don't offer.
+        """
+        steps = [service_operation(operation, point_ops) for operation in operations]
+        if local_operation is None:
+            def local_operation(image):
+                for step in steps:
+                    image = step[2](image)
+                return image
+
+        if len(steps) > 1 and self.supports(self.pipeline_service, "pipeline"):
+            request = {"command": "pipeline", "operations": [step[1] for step in steps]}
+            return self.process(self.pipeline_service, request, image, local_operation, image_format)
+
+        for service, request, step_operation in steps:
+            image = self.process(service, request, image, step_operation, image_format)
+        return image
+
+    def process_in_session(self, session, service, request, image, local_operation, image_format='PNG'):
+        """Like process(), but the image stays on the session service between edits
+
+        Only the first edit of an image uploads it. After that the service
+        already holds the result of the previous edit, so the request carries
+        just the session ID and parameters and only the result comes back.
+        Any edit made elsewhere (undo, local fallbacks, cached results) means
+        the image differs from the session's and is uploaded again. Without
+        session support on the service this is process().
+        """
+        command = request["command"]
+        pixels = self.work_pixels(request, image)
+        # supports() first, process() would route again and take the probe
+        # of a service that is backing off
+        if not self.supports(self.session_service, "session_open") or \
+                self.choose_route(self.session_service, command, pixels) == "local":
+            return self.process(service, request, image, local_operation, image_format)
+
+        endpoint, held = self.sessions.get(session, (None, None))
+        timeout = self.timeout_for(self.session_service, command, pixels)
+        try:
+            print(f"Sending {command} request to ZMQ session...")
+            for attempt in range(2):
+                if held is not image:
+                    endpoint = self.client.choose(self.endpoints[self.session_service])
+                    response, _ = self.request_endpoint(endpoint, self.session_service,
+                                                        {"command": "session_open", "session": session}, image,
+                                                        image_format, timeout)
+                    if response.get("status") != "success":
+                        raise ValueError(response.get("error"))
+                    held = image
+
+                started = time.perf_counter()
+                response, result_image = self.request_endpoint(endpoint, self.session_service,
+                                                               dict(request, session=session, return_image=True),
+                                                               None, image_format, timeout)
+                self.record_remote(self.session_service, command, pixels, time.perf_counter() - started)
+                if response.get("status") == "success" and result_image is not None:
+                    print(f"Successfully processed {command} via ZMQ session")
+                    self.sessions[session] = (endpoint, result_image)
+                    return result_image
+                if not response.get("session_expired"):
+                    break
+                # The service dropped the session, upload the image again
+                held = None
+
+            print(f"ZMQ server error: {response.get('error')}")
+        except zmq.error.Again:
+            print("ZMQ timeout - using local processing")
+            self.record_remote(self.session_service, command, pixels, None, timeout)
+        except Exception as e:
+            print(f"Error in {command} processing: {e}")
+
+        # The session's image is unknown now
+        self.sessions.pop(session, None)
+        return self.process_locally(command, pixels, image, local_operation)
+
+    def close_session(self, session):
+        """Free a session's image on the service, without waiting for long"""
+        endpoint, _ = self.sessions.pop(session, (None, None))
+        if endpoint is None:
+            return
+        try:
+            self.request_endpoint(endpoint, self.session_service, {"command": "session_close", "session": session},
+                                  None, timeout=200)
+        except Exception as e:
+            print(f"Could not close session: {e}")
+
+    def process_locally(self, command, pixels, image, local_operation):
+        started = time.perf_counter()
+        with perf.stage("local"):
+            result_image = local_operation(image)
+        self.model(command, "local").add(pixels, time.perf_counter() - started)
+        return result_image
+
+    @staticmethod
+    def work_pixels(request, image):
+        # Resizes cost roughly in proportion to input plus output pixels
+        pixels = image.width * image.height
+        for step in request.get("operations", [request]):
+            if step["command"] == "resize":
+                pixels += step["width"] * step["height"]
+        return pixels
+
+    def model(self, command, route):
+        key = (command, route)
+        if key not in self.latency:
+            self.latency.setdefault(key, LatencyModel())
+        return self.latency[key]
+
+    def choose_route(self, service, command, pixels):
+        """Return "remote" or "local" for a request of pixels
+
+        A failing service is skipped until its backoff runs out, then one
+        request probes it: a reply ends the backoff, a timeout extends it.
+        Otherwise the route predicted to be faster wins, with every
+        REMOTE_PROBE_INTERVAL-th request still sent to the service, and while
+        little is known about local cost every tenth small request is run
+        locally to learn it.
+        """
+        if not self.adaptive:
+            return "remote"
+
+        health = self.health.get(service)
+        if health:
+            now = time.monotonic()
+            if now < health["retry_at"] or now < health.get("probe_until", 0):
+                return "local"
+            # Other requests stay local until the probe's reply or timeout
+            health["probe_until"] = now + self.max_timeout / 1000
+            return "remote"
+
+        remote = self.model(command, "remote").predict(pixels)
+        local = self.model(command, "local")
+        if local.samples < 3:
+            self.route_count += 1
+            if remote is not None and pixels <= 1000000 and self.route_count % 10 == 0:
+                return "local"
+            return "remote"
+
+        local_time = local.predict(pixels)
+        if remote is not None and local_time < remote:
+            self.local_runs[command] = self.local_runs.get(command, 0) + 1
+            if self.local_runs[command] % self.REMOTE_PROBE_INTERVAL:
+                return "local"
+        return "remote"
+
+    def timeout_for(self, service, command, pixels):
+        """Timeout in ms for a request, three times its predicted latency
+
+        Falls back to the configured timeout before any reply has been seen.
+        """
+        predicted = self.model(command, "remote").predict(pixels) if self.adaptive else None
+        if predicted is None:
+            return self.timeouts.get(service)
+        return int(min(self.max_timeout, max(250, 3 * predicted * 1000 + 100)))
+
+    def record_remote(self, service, command, pixels, seconds, timeout=None):
+        """Learn from a reply, or from a timeout when seconds is None"""
+        if seconds is not None:
+            self.model(command, "remote").add(pixels, seconds)
+            self.health.pop(service, None)
+            return
+
+        # Back off from the service for longer after each consecutive
+        # failure. The timeout isn't a latency sample, the model would keep
+        # predicting it and never send the service another request
+        health = self.health.setdefault(service, {"failures": 0, "retry_at": 0})
+        health["failures"] += 1
+        health["retry_at"] = time.monotonic() + min(60, 2 ** health["failures"])
+        health.pop("probe_until", None)
+        print(f"{service} service unavailable, processing locally for {min(60, 2 ** health['failures'])}s")
+
+    def process_tiled(self, service, request, image, local_operation, image_format='PNG'):
+        """Process a large image as independent tile requests in parallel
+
+        Grayscale and brightness work pixel by pixel so tiles need no overlap.
+        Contrast does too once the mean gray level of the whole image is
+        measured here and pinned in every tile request. Resize tiles are
+        padded by the LANCZOS support and aligned so every tile resamples at
+        exactly the global scale, which makes the stitched result match a
+        single resize. Crops of a large image are done locally, sending the
+        whole image just to cut it is slower. Returns None when the request
+        can't be tiled (some resize ratios can't be aligned), so it is sent in
+        one piece.
+        """
+        command = request["command"]
+        if command == "crop":
+            print("Cropping large image locally")
+            return local_operation(image)
+
+        if command == "contrast":
+            if request.get("mean") is None:
+                request = dict(request, mean=self.point_ops.gray_mean(image, PointOpEngine.IDENTITY))
+            contrast = ("contrast", request["factor"], request["mean"])
+            local_operation = lambda tile: self.point_ops.apply(tile, [contrast])
+
+        if command in ("grayscale", "brightness", "contrast"):
+            columns = self.point_spans(image.width)
+            rows = self.point_spans(image.height)
+            size = image.size
+        elif command == "resize":
+            size = (request["width"], request["height"])
+            columns = self.resize_spans(image.width, size[0])
+            rows = self.resize_spans(image.height, size[1])
+            if columns is None or rows is None:
+                return None
+        else:
+            return None
+
+        if len(columns) * len(rows) < 2:
+            return None
+
+        def run_tile(column, row):
+            (x0, x1, out_width, trim_left, trim_right), (y0, y1, out_height, trim_top, trim_bottom) = column, row
+            tile = image.crop((x0, y0, x1, y1))
+            tile_request = request
+            tile_operation = local_operation
+            if command == "resize":
+                tile_request = dict(request, width=out_width, height=out_height, maintain_aspect=False)
+                tile_operation = lambda t: t.resize((out_width, out_height), Image.Resampling.LANCZOS)
+            result = self.process(service, tile_request, tile, tile_operation, image_format, tiled=False)
+            if result.size != (out_width, out_height):
+                raise ValueError(f"Tile came back as {result.size[0]}x{result.size[1]}")
+            return result.crop((trim_left, trim_top, trim_right, trim_bottom))
+
+        grid = [(column, row) for row in rows for column in columns]
+        print(f"Processing {command} as {len(grid)} tiles")
+        try:
+            with perf.stage("tiles"):
+                tiles = list(self.tile_pool.map(lambda cell: run_tile(*cell), grid))
+        except Exception as e:
+            print(f"Error in tiled {command} processing: {e}")
+            return None
+
+        # Stitch the trimmed tiles back together
+        x_offsets = [sum(span[4] - span[3] for span in columns[:i]) for i in range(len(columns))]
+        y_offsets = [sum(span[4] - span[3] for span in rows[:i]) for i in range(len(rows))]
+        mode = tiles[0].mode
+        result_image = Image.new(mode, size)
+        for i, tile in enumerate(tiles):
+            position = (x_offsets[i % len(columns)], y_offsets[i // len(columns)])
+            result_image.paste(tile if tile.mode == mode else tile.convert(mode), position)
+        return result_image
+
+    def point_spans(self, length):
+        """Split an axis into tiles for per-pixel operations
+
+        Spans are (start, end, output length, trim start, trim end), a tile's
+        output is cropped to [trim start, trim end) before stitching.
+        """
+        return [(start, min(length, start + self.tile_size), min(length, start + self.tile_size) - start,
+                 0, min(length, start + self.tile_size) - start)
+                for start in range(0, length, self.tile_size)]
+
+    def resize_spans(self, length, out_length):
+        """Split an axis into tiles for resizing length to out_length
+
+        Tile edges fall on multiples of out_length / gcd in the output (and
+        length / gcd in the source), so each padded tile maps to a whole
+        number of output pixels at exactly the global scale. Returns None if
+        that unit is larger than a tile.
+        """
+        common = math.gcd(length, out_length)
+        unit = out_length // common
+        source_unit = length // common
+        if out_length <= self.tile_size:
+            return [(0, length, out_length, 0, out_length)]
+        if unit > self.tile_size:
+            return None
+
+        # Pad by the LANCZOS support, measured in source pixels
+        support = 3 * max(1.0, length / out_length) + 1
+        margin = math.ceil(support / source_unit)
+        step = self.tile_size // unit
+
+        spans = []
+        for start in range(0, common, step):
+            end = min(common, start + step)
+            padded_start = max(0, start - margin)
+            padded_end = min(common, end + margin)
+            spans.append((
+                padded_start * source_unit,
+                padded_end * source_unit,
+                (padded_end - padded_start) * unit,
+                (start - padded_start) * unit,
+                (end - padded_start) * unit
+            ))
+        return spans
+
+    def close(self, quit_servers=True):
+        """Release the sockets, first asking the grayscale servers to quit"""
+        for session in list(self.sessions):
+            self.close_session(session)
+        for endpoint in self.endpoints["grayscale"]:
+            if not quit_servers or not self.client.is_connected(endpoint):
+                continue
+            try:
+                # Send quit message to server, don't wait long if it doesn't respond
+                self.client.request(endpoint, [b"Q"], timeout=100, retries=0)
+            except:
+                pass
+        self.tile_pool.shutdown(wait=False)
+        try:
+            self.client.close()
+        except:
+            pass
+
+def operation_request(operation):
+    """Return the service and request for an edit tuple
+
+    Edits are the tuples EditGraph uses, e.g. ("resize", (width, height)).
+    Raises ValueError for edits the services don't offer.
+    """
+    name, value = operation[0], operation[1]
+    if name == "grayscale":
+        return "grayscale", {"command": "grayscale"}
+    if name == "resize":
+        width, height = value
+        return "scaling", {"command": "resize", "width": width, "height": height, "maintain_aspect": False}
+    if name == "crop":
+        left, top, right, bottom = value
+        return "scaling", {"command": "crop", "left": left, "top": top, "right": right, "bottom": bottom}
+    if name in ("brightness", "contrast"):
+        request = {"command": name, "factor": value}
+        if len(operation) > 2 and operation[2] is not None:
+            # A contrast edit pinned to a mean gray level
+            request["mean"] = operation[2]
+        return "adjustments", request
+    raise ValueError(f"Unknown operation: {name}")
+
+def service_operation(operation, point_ops):
+    """Return the service, request and local fallback for an edit tuple"""
+    service, request = operation_request(operation)
+    name, value = operation[0], operation[1]
+    if name == "resize":
+        return service, request, lambda image: image.resize(value, Image.Resampling.LANCZOS)
+    if name == "crop":
+        return service, request, lambda image: image.crop(value)
+    return service, request, lambda image: point_ops.apply(image, [operation])
+
+def parse_operation(text):
+    """Parse a command line edit such as "resize=800x600" into an edit tuple"""
+    name, _, value = text.partition('=')
+    name = name.strip().lower()
+    try:
+        if name == "grayscale":
+            return ("grayscale", None)
+        if name == "resize":
+            width, height = value.lower().split('x')
+            return ("resize", (int(width), int(height)))
+        if name == "crop":
+            left, top, right, bottom = (int(v) for v in value.split(','))
+            return ("crop", (left, top, right, bottom))
+        if name in ("brightness", "contrast"):
+            return (name, float(value))
+    except ValueError:
+        pass
+    raise ValueError(f"Invalid operation '{text}', expected grayscale, resize=WxH, "
+                     "crop=LEFT,TOP,RIGHT,BOTTOM, brightness=F or contrast=F")
+
+_process_point_ops = None
+
+def process_file_locally(path, operations, output_path, image_format=None):
+    """Apply an edit chain to one file in this process, for process pool batches"""
+    global _process_point_ops
+    if _process_point_ops is None:
+        _process_point_ops = PointOpEngine()
+
+    with Image.open(path) as image:
+        image_format = image_format or image.format
+        image.load()
+        for operation in operations:
+            image = service_operation(operation, _process_point_ops)[2](image)
+    save_image(image, output_path, image_format)
+    return output_path
+
+def save_image(image, path, image_format=None):
+    """Save image, converting modes the format can't store"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    image_format = image_format or Image.registered_extensions().get(os.path.splitext(path)[1].lower()) or 'PNG'
+    if image_format.upper() in ('JPEG', 'JPG') and image.mode not in ('L', 'RGB', 'CMYK'):
+        image = image.convert('RGB')
+    image.save(path, format=image_format)
+
+class BatchProcessor():
+    """Applies an edit chain to every file matching a glob, without the viewer
+
+    With services, files go through the ZMQ services from a thread pool (each
+    service call falls back to local processing). Without, they are processed
+    locally in a process pool. Either way at most max_in_flight files are
+    queued at once, so memory stays bounded on large directories.
+    """
+    def __init__(self, services=None, workers=4, max_in_flight=None):
+        self.services = services
+        self.workers = workers
+        self.max_in_flight = max_in_flight or workers * 2
+        self.point_ops = PointOpEngine()
+
+    def process_file(self, path, operations, output_path, image_format=None):
+        """Apply an edit chain to one file through the services"""
+        with Image.open(path) as image:
+            image_format = image_format or image.format
+            image.load()
+            perf.begin("+".join(operation[0] for operation in operations), pixels=image.width * image.height)
+            try:
+                image = self.services.process_chain(operations, image, self.point_ops, image_format=image_format or 'PNG')
+            finally:
+                perf.finish()
+        save_image(image, output_path, image_format)
+        return output_path
+
+    def run(self, pattern, operations, output_dir, image_format=None):
+        """Process every file matching pattern into output_dir and report throughput"""
+        files = sorted(path for path in glob(pattern, recursive=True) if os.path.isfile(path))
+        if not files:
+            print(f"No files match {pattern}")
+            return {"processed": 0, "failed": 0, "seconds": 0.0, "images_per_second": 0.0}
+
+        # Keep the layout below the common directory so names can't collide
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in files])
+        extension = f".{image_format.lower()}" if image_format else None
+
+        if self.services is None:
+            executor = ProcessPoolExecutor(max_workers=self.workers)
+            work = process_file_locally
+        else:
+            executor = ThreadPoolExecutor(max_workers=self.workers)
+            work = self.process_file
+
+        processed = 0
+        failed = 0
+        pending = {}
+        start = time.perf_counter()
+
+        def collect(futures):
+            nonlocal processed, failed
+            for future in futures:
+                path = pending.pop(future)
+                try:
+                    future.result()
+                    processed += 1
+                except Exception as e:
+                    failed += 1
+                    print(f"Failed to process {path}: {e}")
+
+        with executor:
+            for path in files:
+                if len(pending) >= self.max_in_flight:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+
+                output_path = os.path.join(output_dir, os.path.relpath(os.path.abspath(path), root))
+                if extension:
+                    output_path = os.path.splitext(output_path)[0] + extension
+                pending[executor.submit(work, path, operations, output_path, image_format)] = path
+            collect(list(pending))
+
+        seconds = time.perf_counter() - start
+        rate = processed / seconds if seconds > 0 else 0.0
+        print(f"Processed {processed} images in {seconds:.2f}s ({rate:.1f} images/sec), {failed} failed")
+        return {"processed": processed, "failed": failed, "seconds": seconds, "images_per_second": rate}
+
+def run_batch(argv):
+    """Command line entry point for batch processing"""
+    parser = argparse.ArgumentParser(
+        description="Apply edits to every image matching a glob, without opening the viewer"
+    )
+    parser.add_argument("pattern", help='glob of input files, e.g. "photos/**/*.jpg"')
+    parser.add_argument("-o", "--output", required=True, help="directory for the edited images")
+    parser.add_argument("--op", dest="operations", action="append", type=parse_operation, required=True,
+                        help="edit to apply, repeat for a chain: grayscale, resize=WxH, "
+                             "crop=LEFT,TOP,RIGHT,BOTTOM, brightness=F, contrast=F")
+    parser.add_argument("--local", action="store_true", help="process in a local process pool instead of the services")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="parallel workers")
+    parser.add_argument("--in-flight", type=int, default=None, help="maximum files queued at once")
+    parser.add_argument("--format", default=None, help="output format, defaults to each input's format")
+    parser.add_argument("--trace", default=None, help="append per-stage timings of service calls to a JSON-lines file")
+    args = parser.parse_args(argv)
+
+    if args.trace:
+        perf.open_trace(args.trace)
+
+    services = None
+    if not args.local:
+        config = dotenv_values('.env')
+        # Let every worker hold its own socket to each service
+        config.setdefault('ZMQ_POOL_SIZE', str(args.workers))
+        services = ImageServices(config)
+
+    try:
+        BatchProcessor(services, args.workers, args.in_flight).run(args.pattern, args.operations, args.output, args.format)
+        for operation, stages in perf.stats().items():
+            timings = ", ".join(f"{name} {stats['p50_ms']:.1f}" for name, stats in stages.items())
+            print(f"{operation} p50 ms: {timings}")
+    finally:
+        if services is not None:
+            services.close(quit_servers=False)
 
 class ImageProperties():
     def __init__(self):
@@ -26,30 +1871,168 @@ class ImageProperties():
         self.image_color_mode = ""
         self.image_size = 0
 
+        # "json" sends the base64 encoded file like the original service expects,
+        # "multipart" streams the raw file as a multipart/form-data upload
+        self.upload_mode = self.config.get('PROPS_UPLOAD_MODE') or 'json'
+        self.timeout = float(self.config.get('PROPS_TIMEOUT') or 10)
+        self.session = self.create_session(
+            pool_size=int(self.config.get('PROPS_POOL_SIZE') or 4),
+            retries=int(self.config.get('PROPS_RETRIES') or 2)
+        )
+
+    def create_session(self, pool_size=4, retries=2):
+        """Create a keep-alive session so lookups reuse their connections"""
+        session = requests.Session()
+        # Only retry failed connection attempts, the request body hasn't been
+        # sent at that point so this is safe for streamed uploads as well
+        retry = Retry(total=retries, connect=retries, read=0, status=0, backoff_factor=0.2)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def multipart_body(self, stream, filename, boundary, chunk_size=64 * 1024):
+        """Yield a multipart/form-data body, reading the stream a chunk at a time"""
+        yield (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="image"; filename="{filename}"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode('utf-8')
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        yield f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+    def post_file(self, file, filename='image'):
+        """Send a file path or binary stream to the properties service"""
+        if isinstance(file, (str, os.PathLike)):
+            with open(file, 'rb') as stream:
+                return self.post_file(stream, os.path.basename(file))
+
+        if self.upload_mode == 'multipart':
+            # A generator body is sent with chunked encoding, so the file is
+            # never held in memory or base64 inflated
+            boundary = uuid.uuid4().hex
+            headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+            return self.session.post(self.url, data=self.multipart_body(file, filename, boundary),
+                                     headers=headers, timeout=self.timeout)
+
+        base64_img_string = base64.b64encode(file.read()).decode('UTF-8')
+
+        req_data = {
+            "image" : base64_img_string
+        }
+        return self.session.post(self.url, json=req_data, timeout=self.timeout)
+
+    def extract_local_data(self, file):
+        """Read the properties from the file header without decoding any pixels
+
+        Fields that can't be determined locally are left as None.
+        """
+        img_data = dict.fromkeys(PROPERTY_FIELDS)
+        try:
+            # Image.open is lazy, it only parses the header until load() is called
+            with Image.open(file) as img:
+                img_data['width'] = img.width
+                img_data['heigth'] = img.height
+                img_data['format'] = img.format
+                img_data['color_mode'] = img.mode
+            img_data['file_size'] = os.stat(file).st_size
+        except Exception as exc:
+            print(f"Could not read image header locally: {exc}")
+        return img_data
+
+    def estimate_encoded_size(self, image, image_format='PNG', tile=128):
+        """Estimate the encoded size of an image without encoding all of it
+
+        Encodes a mosaic of full resolution tiles taken from the four quadrants
+        and scales the result by the pixel count.
+        """
+        pixels = image.width * image.height
+        if pixels <= 4 * tile * tile:
+            sample = image
+        else:
+            tile_w = min(tile, image.width // 2)
+            tile_h = min(tile, image.height // 2)
+            sample = Image.new(image.mode, (tile_w * 2, tile_h * 2))
+            for i, (fx, fy) in enumerate(((0.25, 0.25), (0.75, 0.25), (0.25, 0.75), (0.75, 0.75))):
+                left = int(image.width * fx) - tile_w // 2
+                top = int(image.height * fy) - tile_h // 2
+                region = image.crop((left, top, left + tile_w, top + tile_h))
+                sample.paste(region, ((i % 2) * tile_w, (i // 2) * tile_h))
+
+        if image_format == 'JPEG' and sample.mode not in ('L', 'RGB', 'CMYK'):
+            sample = sample.convert('RGB')
+        buffer = io.BytesIO()
+        sample.save(buffer, format=image_format)
+        return int(buffer.tell() * pixels / (sample.width * sample.height))
+
+    def extract_image_data(self, image, image_format=None, size=None):
+        """Get the properties of an in-memory image, estimating the file size
+
+        image may be a downscaled preview when size gives the real dimensions.
+        The service is only called, with an in-memory buffer, if the estimate
+        can't be made locally.
+        """
+        image_format = image_format or image.format or 'PNG'
+        width, height = size or image.size
+        img_data = {
+            'width': width,
+            'heigth': height,
+            'format': image_format,
+            'color_mode': image.mode,
+            'file_size': None,
+            'estimated': True
+        }
+        try:
+            img_data['file_size'] = self.estimate_encoded_size(image, image_format)
+            img_data['file_size'] = int(img_data['file_size'] * width * height / (image.width * image.height))
+        except Exception as exc:
+            print(f"Could not estimate encoded size locally: {exc}")
+            try:
+                buffer = io.BytesIO()
+                image.save(buffer, format=image_format)
+                buffer.seek(0)
+                resp = self.post_file(buffer, f"image.{image_format.lower()}")
+                img_data['file_size'] = json.loads(resp.text)['file_size']
+                img_data['estimated'] = False
+            except Exception as exc:
+                print(f"Unexpected Exception: {exc}")
+                return None
+
+        self.image_width = img_data['width']
+        self.image_height = img_data['heigth']
+        self.image_color_mode = img_data['color_mode']
+        self.image_size = img_data['file_size']
+
+        return img_data
 
     def extract_data(self, file):
-        with open(file, 'rb') as img:
-            base64_img_string = base64.b64encode(img.read()).decode('UTF-8')
+        img_data = self.extract_local_data(file)
 
-            req_data = {
-                "image" : base64_img_string
-            }
-            
+        # Only ask the microservice when the header didn't give us everything
+        missing = [field for field in PROPERTY_FIELDS if img_data[field] is None]
+        if missing:
             try:                
-                resp = requests.post(self.url, json=req_data)
-                img_data = json.loads(resp.text)
-                self.image_width = img_data['width']
-                self.image_height = img_data['heigth']
-                self.image_format = img_data['format']
-                self.image_color_mode = img_data['color_mode']
-                self.image_size = img_data['file_size']
-
-                return img_data
+                resp = self.post_file(file)
+                remote_data = json.loads(resp.text)
+                for field in missing:
+                    img_data[field] = remote_data[field]
             
             except Exception as exc:
                 print(f"Unexpected Exception: {exc}")
                 return None
 
+        self.image_width = img_data['width']
+        self.image_height = img_data['heigth']
+        self.image_format = img_data['format']
+        self.image_color_mode = img_data['color_mode']
+        self.image_size = img_data['file_size']
+
+        return img_data
+
 class ImageViewer():
     def __init__(self):
         #initialize GUI window
@@ -83,6 +2066,26 @@ class ImageViewer():
             underline=-1
         )
         
+        #create edit menu with undo/redo
+        self.edit_menu = tk.Menu(
+            self.menubar,
+            tearoff=0,
+            relief='solid',
+            border=1,
+            activeborderwidth=1
+        )
+
+        #add edit cascade menu
+        self.menubar.add_cascade(
+            label="Edit",
+            menu=self.edit_menu,
+            underline=-1
+        )
+        self.edit_menu.add_command(label="Undo", command=self.undo, accelerator="Ctrl+Z")
+        self.edit_menu.add_command(label="Redo", command=self.redo, accelerator="Ctrl+Y")
+        self.window.bind('<Control-z>', self.undo)
+        self.window.bind('<Control-y>', self.redo)
+
         #create filter menu with border
         self.filter_menu = tk.Menu(
             self.menubar,
@@ -229,8 +2232,8 @@ class ImageViewer():
         )
         self.tip_label.grid(row=0, column=0, padx=5, pady=5, sticky='nw')
 
-        #store our current image
-        self.current_image = None
+        #store our current image, as a source image plus pending edits
+        self.edit_graph = None
         
         # Store original image (before filters are applied)
         self.original_image = None
@@ -241,8 +2244,6 @@ class ImageViewer():
         # Initialize image properties instance
         self.image_prop = ImageProperties()
 
-        self.zmq_context = None
-        self.zmq_socket = None
 
             # Add scaling menu after filter_menu is created
         self.scaling_menu = tk.Menu(
@@ -266,19 +2267,6 @@ class ImageViewer():
         self.scaling_menu.add_separator()
         self.scaling_menu.add_command(label="Revert to Original Size", command=self.revert_to_original)
         
-        # Add ZMQ variables for scaling service
-        self.scaling_zmq_context = None
-        self.scaling_zmq_socket = None
-        self.scaling_endpoint = "tcp://localhost:5556"
-        
-        # Add ZMQ configuration to your existing config
-        try:
-            self.zmq_port = self.image_prop.config.get('ZMQ_PORT', '5555')
-            self.zmq_host = self.image_prop.config.get('ZMQ_HOST', 'localhost')
-            self.zmq_endpoint = f"tcp://{self.zmq_host}:{self.zmq_port}"
-        except:
-            # Default values if config loading fails
-            self.zmq_endpoint = "tcp://localhost:5555"
 
             # Add a new Adjustments menu
         self.adjustments_menu = tk.Menu(
@@ -299,72 +2287,370 @@ class ImageViewer():
 
         self.adjustments_menu.add_command(label="Brightness", command=self.open_brightness_dialog)
         self.adjustments_menu.add_command(label="Contrast", command=self.open_contrast_dialog)
-        
-        # Add ZMQ variables for adjustments service
-        self.adjustments_zmq_context = None
-        self.adjustments_zmq_socket = None
-        self.adjustments_endpoint = "tcp://localhost:5557"    
 
-    def init_zmq(self):
-        """Initialize ZMQ connection if not already done"""
-        try:
-            # Only initialize once
-            if not hasattr(self, 'zmq_socket') or self.zmq_socket is None:
-                print("Initializing ZMQ connection...")
-                self.zmq_context = zmq.Context()
-                self.zmq_socket = self.zmq_context.socket(zmq.REQ)
-                self.zmq_socket.setsockopt(zmq.LINGER, 0)
-                self.zmq_socket.setsockopt(zmq.RCVTIMEO, 2000)  # 2 second timeout
-                self.zmq_socket.connect("tcp://localhost:5555")
-            return True
-        except Exception as e:
-            print(f"ZMQ initialization error: {e}")
-            return False
-        
-    def init_scaling_zmq(self):
-        """Initialize ZMQ connection for scaling if not already done"""
+
+        # ZMQ image services, endpoints and timeouts come from the config
+        config = self.image_prop.config
+        self.services = ImageServices(config)
+
+        # Undo/redo history, compressed and spilled to disk past its budget
+        self.history = EditHistory(
+            max_bytes=int(config.get('HISTORY_MB') or 128) * 1024 * 1024,
+            max_steps=int(config.get('HISTORY_STEPS') or 50)
+        )
+
+        # Lookup table engine for local point operations and previews
+        self.point_ops = PointOpEngine()
+
+        # Service calls run in the background so the UI stays responsive.
+        # Edits submitted while one runs wait for it, see submit_edit
+        self.jobs = JobExecutor(self.window)
+        self.running_edit = None
+        self.edit_queue = deque()
+
+        # Cached display scaling state, see resize_image and on_resize
+        self.display_pyramid = None
+        self.display_size = None
+        self.resize_timer = None
+        self.resize_delay = 100
+        self.refine_job = None
+
+        # File being decoded in the background after a fast open, see upload_image
+        self.loading_path = None
+
+        # With lazy edits the edit graph is only rendered at full resolution
+        # on save, the view and dialogs work from previews
+        self.lazy_edits = config.get('LAZY_EDITS', '0') in ('1', 'true', 'True')
+        self.source_pyramid = None
+        self.display_source = None
+
+        # Show a quick render first and refine it when idle, unless disabled
+        self.display_quality = 'high' if config.get('PROGRESSIVE_DISPLAY', '1') in ('0', 'false', 'False') else 'progressive'
+
+        # With session mode the image is uploaded once and stays on the
+        # service between edits, see ImageServices.process_in_session
+        self.session_mode = config.get('SESSION_MODE', '0') in ('1', 'true', 'True')
+        self.session_id = uuid.uuid4().hex
+
+        # Per-stage timings, optionally shown in the tip bar and traced to a file
+        self.perf_overlay = config.get('PERF_OVERLAY', '0') in ('1', 'true', 'True')
+        if config.get('PERF_TRACE'):
+            perf.open_trace(config.get('PERF_TRACE'))
+
+        # Pending properties refresh, see update_image_properties
+        self.properties_timer = None
+        self.properties_delay = 300
+
+        # Results of service operations, so repeating an edit is free
+        self.result_cache = ResultCache(
+            max_bytes=int(config.get('RESULT_CACHE_MB') or 256) * 1024 * 1024,
+            cache_dir=config.get('RESULT_CACHE_DIR') or None,
+            max_disk_bytes=int(config.get('RESULT_CACHE_DISK_MB') or 1024) * 1024 * 1024
+        )
+
+    @property
+    def current_image(self):
+        """The edited image at full resolution, rendered on first access"""
+        if self.edit_graph is None:
+            return None
+        return self.edit_graph.render(self.render_with_services)
+
+    @current_image.setter
+    def current_image(self, image):
+        self.edit_graph = None if image is None else EditGraph(image, self.point_ops)
+
+    def render_with_services(self, source, operations, render_locally):
+        """Render pending edits in one pipeline request, see EditGraph.render"""
+        if not self.services.supports(self.services.pipeline_service, "pipeline"):
+            # Without pipelines, one request per edit is slower than rendering here
+            return render_locally(source)
+
+        image_format = getattr(source, 'format', 'PNG') or 'PNG'
+        # Runs inside other traces (edits, saves), put theirs back afterwards
+        outer = perf.current()
+        trace = perf.begin("render", pixels=source.width * source.height)
         try:
-            # Only initialize once
-            if not hasattr(self, 'scaling_zmq_socket') or self.scaling_zmq_socket is None:
-                print("Initializing Scaling ZMQ connection...")
-                self.scaling_zmq_context = zmq.Context()
-                self.scaling_zmq_socket = self.scaling_zmq_context.socket(zmq.REQ)
-                self.scaling_zmq_socket.setsockopt(zmq.LINGER, 0)
-                self.scaling_zmq_socket.setsockopt(zmq.RCVTIMEO, 3000)  # 3 second timeout
-                self.scaling_zmq_socket.connect(self.scaling_endpoint)
-            return True
-        except Exception as e:
-            print(f"Scaling ZMQ initialization error: {e}")
+            return self.services.process_chain(operations, source, self.point_ops, render_locally, image_format)
+        except ValueError:
+            # An edit the services don't offer
+            return render_locally(source)
+        finally:
+            perf.finish(trace)
+            perf.resume(outer)
+
+    def has_image(self):
+        """Check for a loaded image without rendering pending edits"""
+        return getattr(self, 'edit_graph', None) is not None
+
+    def is_loading(self):
+        """Check for a file still being decoded, telling the user why edits wait for it"""
+        if self.loading_path is None:
             return False
-        
-    def init_adjustments_zmq(self):
-        """Initialize ZMQ connection for image adjustments if not already done"""
-        try:
-            # Only initialize once
-            if not hasattr(self, 'adjustments_zmq_socket') or self.adjustments_zmq_socket is None:
-                print("Initializing Adjustments ZMQ connection...")
-                self.adjustments_zmq_context = zmq.Context()
-                self.adjustments_zmq_socket = self.adjustments_zmq_context.socket(zmq.REQ)
-                self.adjustments_zmq_socket.setsockopt(zmq.LINGER, 0)
-                self.adjustments_zmq_socket.setsockopt(zmq.RCVTIMEO, 2000)  # 2 second timeout
-                self.adjustments_zmq_socket.connect(self.adjustments_endpoint)
-            return True
-        except Exception as e:
-            print(f"Adjustments ZMQ initialization error: {e}")
+        self.update_tip(f"Still loading {os.path.basename(self.loading_path)}, edits are available once it is shown")
+        return True
+
+    def is_editing(self):
+        """Check for edits still being processed, telling the user a save has to wait for them"""
+        if self.running_edit is None:
             return False
+        queued = f" and {len(self.edit_queue)} queued edits" if self.edit_queue else ""
+        self.update_tip(f"Still applying {self.running_edit[1]['command']}{queued}, save once they are done")
+        return True
+
+    def preview_current_image(self, max_width, max_height):
+        """Render the current image at about max_width x max_height"""
+        if self.source_pyramid is None or self.source_pyramid.source is not self.edit_graph.source:
+            self.source_pyramid = DisplayPyramid(self.edit_graph.source)
+        return self.edit_graph.render_preview(max_width, max_height, self.source_pyramid)
+
+    def show_current_image(self, quality=None):
+        """Fit the current image, or a preview of its pending edits, to the frame"""
+        frame_width = self.main_frame.winfo_width()
+        frame_height = self.main_frame.winfo_height()
+        if self.edit_graph.ops:
+            image = self.preview_current_image(frame_width, frame_height)
+        else:
+            image = self.edit_graph.source
+        self.resize_image(image, frame_width, frame_height, quality)
+
+    def push_edit(self, operation, done_message, update_properties=True):
+        """Record an edit in the edit graph without rendering it"""
+        self.cancel_edits()
+
+        if operation[0] == "contrast" and len(operation) < 3:
+            # Pin the mean gray level now, so the edit can be reordered later
+            preview = self.preview_current_image(256, 256)
+            operation = operation + (self.point_ops.gray_mean(preview, PointOpEngine.IDENTITY),)
+
+        self.edit_graph.push(*operation)
+        self.history.record_push(operation)
+        self.filters_applied = True
+        self.show_current_image()
+        self.update_tip(done_message)
+        if update_properties:
+            self.update_image_properties()
+
+    def replace_current_image(self, image, record):
+        """Replace the current image, recording the change in the history
+
+        record is the history entry built with EditHistory.make_replace in a
+        background job, compressing large images takes seconds.
+        """
+        self.current_image = image
+        self.history.add(record)
+
+    def undo(self, event=None):
+        """Step back one edit"""
+        if self.is_loading():
+            return
+        if self.cancel_edits():
+            self.update_tip("Cancelled pending edits")
+            return
+        if not self.has_image() or not self.history.can_undo():
+            self.update_tip("Nothing to undo")
+            return
+        self.edit_graph = self.history.undo(self.edit_graph)
+        self.after_history_step("Undid last edit")
+
+    def redo(self, event=None):
+        """Apply the last undone edit again"""
+        if self.is_loading():
+            return
+        if not self.has_image() or not self.history.can_redo():
+            self.update_tip("Nothing to redo")
+            return
+        self.cancel_edits()
+        self.edit_graph = self.history.redo(self.edit_graph)
+        self.after_history_step("Redid edit")
+
+    def after_history_step(self, message):
+        self.filters_applied = self.history.can_undo()
+        self.show_current_image()
+        self.update_tip(message)
+        self.update_image_properties()
+
+    # A newer edit of these kinds replaces a pending one of the same kind
+    # rather than running on its result, the result wouldn't differ
+    SUPERSEDING_EDITS = ("resize",)
+
+    def submit_edit(self, service, request, local_operation, done_message, image_format='PNG',
+                    update_properties=True, edit=None):
+        """Process the current image in the background and show the result
+
+        An edit submitted while another is still running is queued and runs
+        on its result, except that a resize replaces a pending resize. With
+        lazy edits enabled, edit is recorded in the edit graph instead.
+        """
+        if self.lazy_edits and edit is not None:
+            self.push_edit(edit, done_message, update_properties)
+            return
+
+        job = (service, request, local_operation, done_message, image_format, update_properties)
+        if self.running_edit is None:
+            self.start_edit(job)
+            return
+
+        pending = self.edit_queue[-1] if self.edit_queue else self.running_edit
+        if request["command"] in self.SUPERSEDING_EDITS and pending[1]["command"] == request["command"]:
+            if self.edit_queue:
+                self.edit_queue[-1] = job
+            else:
+                # The running edit's input is still the current image
+                self.jobs.cancel("edit")
+                self.start_edit(job)
+            return
+
+        self.edit_queue.append(job)
+        self.update_tip(f"Queued {request['command']}, waiting for {self.running_edit[1]['command']}")
+
+    def cancel_edits(self):
+        """Drop the running edit and any queued ones, returns True if there were any"""
+        pending = self.running_edit is not None
+        self.jobs.cancel("edit")
+        self.running_edit = None
+        self.edit_queue.clear()
+        return pending
+
+    def start_edit(self, job):
+        """Run a job of submit_edit on the current image"""
+        service, request, local_operation, done_message, image_format, update_properties = job
+        self.running_edit = job
+        # Pending lazy edits are rendered in the worker, from a copy the Tk
+        # thread can't change in the meantime
+        graph = self.edit_graph.copy()
+        before_source, before_ops = graph.source, tuple(graph.ops)
+        width, height = graph.size()
+        trace = perf.begin(request["command"], attach=False, pixels=width * height)
+
+        def process():
+            image = graph.render(self.render_with_services)
+            key = self.result_cache.make_key(image, service, request)
+            cached_image = self.result_cache.get(key)
+            if cached_image is not None:
+                print(f"Using cached result for {request['command']}")
+                return cached_image
+
+            if self.session_mode:
+                result_image = self.services.process_in_session(self.session_id, service, request, image,
+                                                                local_operation, image_format)
+            else:
+                result_image = self.services.process(service, request, image, local_operation, image_format)
+            self.result_cache.put(key, result_image)
+            return result_image
+
+        def work():
+            perf.resume(trace)
+            try:
+                result_image = process()
+                # Build the undo entry here too, diffing a large image takes seconds
+                with perf.stage("history"):
+                    record = self.history.make_replace(before_source, before_ops, result_image, ())
+                return result_image, record
+            finally:
+                perf.resume(None)
+
+        def done(result):
+            # Update the image
+            self.running_edit = None
+            result_image, record = result
+            self.replace_current_image(result_image, record)
+            self.filters_applied = True
+
+            # Update the display, timed as part of the operation
+            perf.resume(trace)
+            self.show_current_image()
+            perf.finish(trace)
+
+            # Update the tip
+            self.update_tip(f"{done_message}  |  {perf.summary(trace)}" if self.perf_overlay else done_message)
+
+            # Update image properties
+            if update_properties:
+                self.update_image_properties()
+
+            # Queued edits run on this result
+            if self.edit_queue:
+                self.start_edit(self.edit_queue.popleft())
+
+        def failed(e):
+            perf.finish(trace)
+            # Queued edits were meant for this edit's result, drop them too
+            dropped = len(self.edit_queue)
+            self.cancel_edits()
+            message = f"Could not process image: {e}"
+            self.update_tip(f"{message} ({dropped} queued edits dropped)" if dropped else message)
+
+        self.jobs.submit("edit", work, done, failed)
+
+    def restore_image(self, image, on_restored):
+        """Make image the current one again, e.g. the original
+
+        The history entry is built in the background like an edit's, edits
+        submitted in the meantime queue behind it.
+        """
+        self.cancel_edits()
+        graph = self.edit_graph.copy()
+        self.running_edit = (None, {"command": "restore"}, None, None, None, False)
+        self.update_tip("Restoring the original image...")
+
+        def work():
+            return self.history.make_replace(graph.source, tuple(graph.ops), image, ())
+
+        def done(record):
+            self.running_edit = None
+            self.replace_current_image(image, record)
+            on_restored()
+
+            if self.edit_queue:
+                self.start_edit(self.edit_queue.popleft())
+
+        def failed(e):
+            self.cancel_edits()
+            self.update_tip(f"Could not restore the original image: {e}")
+
+        self.jobs.submit("edit", work, done, failed)
 
     def on_resize(self, event):
         #only resize if we have an image
-        if hasattr(self, 'current_image') and self.current_image:
+        if self.has_image():
             #get the new dimensions
             frame_width = self.main_frame.winfo_width()
             frame_height = self.main_frame.winfo_height()
-            
-            #resize image to fit new dimensions
-            self.resize_image(self.current_image, frame_width, frame_height)
 
-    def resize_image(self, image, frame_width, frame_height):
-        """Resize the image for display purposes"""
+            #<Configure> also fires for child widgets, skip if the frame didn't change
+            if (frame_width, frame_height) == self.display_size:
+                return
+
+            #show a quick render of what is already on screen while the window is dragged
+            if self.display_source is not None:
+                self.resize_image(self.display_source, frame_width, frame_height, quality='fast')
+
+            #coalesce events, only the final size gets the high quality render
+            if self.resize_timer is not None:
+                self.window.after_cancel(self.resize_timer)
+            self.resize_timer = self.window.after(self.resize_delay, self.redraw_image)
+
+    def redraw_image(self):
+        """Resize the current image to fit the frame"""
+        self.resize_timer = None
+        if self.has_image():
+            self.show_current_image(quality='high')
+
+    def refine_image(self, image, frame_width, frame_height):
+        """Replace a quick render with the high quality one"""
+        self.refine_job = None
+        if image is self.display_source:
+            self.resize_image(image, frame_width, frame_height, quality='high')
+
+    def resize_image(self, image, frame_width, frame_height, quality=None):
+        """Resize the image for display purposes
+
+        quality is 'high' for a LANCZOS render, 'fast' for a BILINEAR one, or
+        'progressive' to show the fast render immediately and replace it with
+        the LANCZOS render once Tk is idle. Defaults to self.display_quality.
+        """
+        quality = quality or self.display_quality
+
         # Calculate scaling factor
         img_width, img_height = image.size
         width_ratio = frame_width / img_width
@@ -372,23 +2658,48 @@ class ImageViewer():
         scale_factor = min(width_ratio, height_ratio)
         
         # Calculate new dimensions
-        new_width = int(img_width * scale_factor)
-        new_height = int(img_height * scale_factor)
-        
-        resized_image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        new_width = max(1, int(img_width * scale_factor))
+        new_height = max(1, int(img_height * scale_factor))
+        
+        # Start from the nearest pyramid level, rebuilt only when the image changes
+        if self.display_pyramid is None or self.display_pyramid.source is not image:
+            self.display_pyramid = DisplayPyramid(image)
+        source = self.display_pyramid.level_for(new_width, new_height)
+
+        # A newer render makes any pending refinement obsolete
+        if self.refine_job is not None:
+            self.window.after_cancel(self.refine_job)
+            self.refine_job = None
+
+        with perf.stage("resample"):
+            if source.size == (new_width, new_height):
+                resized_image = source
+            elif quality == 'high':
+                resized_image = source.resize((new_width, new_height), Image.Resampling.LANCZOS)
+            else:
+                # The pyramid level is at most twice the target size, so bilinear
+                # is fast and good enough until the refined render replaces it
+                resized_image = source.resize((new_width, new_height), Image.Resampling.BILINEAR)
+                if quality == 'progressive':
+                    self.refine_job = self.window.after_idle(self.refine_image, image, frame_width, frame_height)
+        self.display_size = (frame_width, frame_height)
+        self.display_source = image
         
         # Update PhotoImage
-        photo = ImageTk.PhotoImage(resized_image)
+        with perf.stage("photoimage"):
+            photo = ImageTk.PhotoImage(resized_image)
         self.image_label.configure(image=photo)
         self.image_label.image = photo
 
         
 
     def save_image(self):
-        if hasattr(self, 'current_image') and self.current_image:
+        if self.is_loading() or self.is_editing():
+            return
+        if self.has_image():
             if hasattr(self, 'current_file_path'):
                 #save to the same file it was opened from
-                self.current_image.save(self.current_file_path)
+                self.save_current_image(self.current_file_path)
             else:
                 #if no current file path, use save as
                 self.save_image_as()
@@ -396,7 +2707,9 @@ class ImageViewer():
             tk.messagebox.showwarning("Warning", "No image to save!")
 
     def save_image_as(self):
-        if hasattr(self, 'current_image') and self.current_image:
+        if self.is_loading() or self.is_editing():
+            return
+        if self.has_image():
             file_path = filedialog.asksaveasfilename(
                 defaultextension=".png",
                 filetypes=[
@@ -406,11 +2719,35 @@ class ImageViewer():
                 ]
             )
             if file_path:
-                self.current_image.save(file_path)
-                self.current_file_path = file_path
+                self.save_current_image(file_path)
         else:
             tk.messagebox.showwarning("Warning", "No image to save!")
 
+    def save_current_image(self, file_path):
+        """Render pending edits in the background, then write the image to file_path
+
+        With lazy edits this is the full resolution render, which may be a
+        pipeline request to the services. Saves to different files run side
+        by side, a later save to the same file supersedes the pending one.
+        """
+        graph = self.edit_graph.copy()
+        if graph.ops:
+            self.update_tip("Saving: rendering edits...")
+
+        def done(image):
+            try:
+                image.save(file_path)
+            except Exception as e:
+                self.update_tip(f"Could not save image: {e}")
+                return
+            self.current_file_path = file_path
+            self.update_tip(f"Saved {os.path.basename(file_path)}")
+
+        def failed(e):
+            self.update_tip(f"Could not save image: {e}")
+
+        self.jobs.submit(f"save:{file_path}", lambda: graph.render(self.render_with_services), done, failed)
+
     def update_properties(self, img_data):
         # Update properties display
         if img_data:
@@ -425,6 +2762,8 @@ class ImageViewer():
                 size_str = f"{size_kb:.1f} KB"
             else:
                 size_str = f"{size_kb/1024:.2f} MB"
+            if img_data.get('estimated'):
+                size_str = f"~{size_str}"
             
             self.prop_labels["File Size:"].config(text=size_str)
             
@@ -432,8 +2771,8 @@ class ImageViewer():
             self.update_tip(f"Current image: {img_data['width']}×{img_data['heigth']} pixels, {img_data['format']} format")
 
     def upload_image(self, event=None):
-        #check if an image is already loaded and being displayed
-        if hasattr(self, 'image_label') and self.current_image is not None:
+        #check if an image is already loaded and being displayed, or still loading
+        if self.has_image() or self.loading_path is not None:
             #show warning
             response = messagebox.askyesno(
                 "Warning",
@@ -450,30 +2789,92 @@ class ImageViewer():
         )
         
         if file_path:
-            #store the original image and file path
-            self.current_image = Image.open(file_path)
-            self.original_image = self.current_image.copy()  # Make a copy for restoration
+            #drop any edit still being processed on the previous image
+            self.cancel_edits()
+
+            #no image until the full decode is ready, edits would only see the preview
+            self.history.clear()
+            self.current_image = None
+            self.original_image = None
             self.filters_applied = False
             self.current_file_path = file_path
+            self.loading_path = file_path
 
             # Get image properties and update the properties panel
             img_data = self.image_prop.extract_data(file_path)
             if img_data:
                 self.update_properties(img_data)
-            
-            #get current frame dimensions
-            frame_width = self.main_frame.winfo_width()
-            frame_height = self.main_frame.winfo_height()
-            
-            #resize image to fit frame
-            self.resize_image(self.current_image, frame_width, frame_height)
-            
+
             #hide instruction text
             self.instruction.grid_remove()
 
+            self.open_image(file_path, img_data)
+
+    def open_image(self, file_path, img_data=None):
+        """Show a quick preview of a file at once and the full image when it is decoded
+
+        The EXIF thumbnail is shown straight away if there is one, otherwise a
+        JPEG is decoded at a reduced scale in the background. The full decode
+        runs in the background too and replaces the preview when it's ready.
+        """
+        trace = perf.begin("open", attach=False)
+        frame_width = self.main_frame.winfo_width()
+        frame_height = self.main_frame.winfo_height()
+
+        def show_preview(preview):
+            if self.loading_path != file_path or preview is None:
+                return
+            perf.add("first_pixel", (time.perf_counter() - trace["started"]) * 1000, trace)
+            self.resize_image(preview, frame_width, frame_height)
+
+        try:
+            with Image.open(file_path) as header:
+                thumbnail = exif_thumbnail(header)
+        except Exception:
+            thumbnail = None
+        if thumbnail is not None:
+            show_preview(thumbnail)
+        else:
+            #don't leave the previous image up next to this file's properties,
+            #a PNG has no draft preview so the frame stays empty until decoded
+            self.clear_display()
+            self.jobs.submit("open_preview", lambda: draft_image(file_path, frame_width, frame_height), show_preview)
+        self.update_tip("Loading full resolution image...")
+
+        def work():
+            perf.resume(trace)
+            try:
+                with perf.stage("decode"):
+                    image = Image.open(file_path)
+                    image.load()
+                    return image, image.copy()  # Keep a copy for restoration
+            finally:
+                perf.resume(None)
+
+        def done(images):
+            self.jobs.cancel("open_preview")
+            self.loading_path = None
+            self.current_image, self.original_image = images
+
+            perf.resume(trace)
+            self.show_current_image()
+            perf.finish(trace)
+            if img_data:
+                self.update_properties(img_data)
+            if self.perf_overlay:
+                self.update_tip(perf.summary(trace))
+
+        def failed(e):
+            perf.finish(trace)
+            self.loading_path = None
+            self.clear_display()
+            self.update_tip(f"Could not open image: {e}")
+
+        self.jobs.submit("open", work, done, failed)
+
     def confirm_exit(self):
         #check if there's an image loaded and potentially unsaved changes
-        if hasattr(self, 'current_image') and self.current_image is not None:
+        if self.has_image():
             response = messagebox.askyesno(
                 "Exit",
                 "Are you sure you want to exit?\nAny unsaved changes will be lost.",
@@ -482,59 +2883,33 @@ class ImageViewer():
             if not response:
                 return
         
-        # Clean up ZMQ resources
-        if hasattr(self, 'zmq_socket') and self.zmq_socket is not None:
-            try:
-                # Send quit message to server
-                try:
-                    self.zmq_socket.send_string("Q")
-                    self.zmq_socket.recv(zmq.NOBLOCK)  # Don't block if server doesn't respond
-                except:
-                    pass
-                self.zmq_socket.close()
-            except:
-                pass
-        if hasattr(self, 'zmq_context') and self.zmq_context is not None:
-            try:
-                self.zmq_context.term()
-            except:
-                pass
-        
-                # Add cleanup for scaling ZMQ
-        if hasattr(self, 'scaling_zmq_socket') and self.scaling_zmq_socket is not None:
-            try:
-                self.scaling_zmq_socket.close()
-            except:
-                pass
-        
-        if hasattr(self, 'scaling_zmq_context') and self.scaling_zmq_context is not None:
-            try:
-                self.scaling_zmq_context.term()
-            except:
-                pass
+        # Stop background jobs
+        self.jobs.shutdown()
+        print(f"Result cache: {self.result_cache.stats()}")
+        print(f"Timings: {json.dumps(perf.stats())}")
 
-        # Add cleanup for adjustments ZMQ
-        if hasattr(self, 'adjustments_zmq_socket') and self.adjustments_zmq_socket is not None:
-            try:
-                self.adjustments_zmq_socket.close()
-            except:
-                pass
-        
-        if hasattr(self, 'adjustments_zmq_context') and self.adjustments_zmq_context is not None:
-            try:
-                self.adjustments_zmq_context.term()
-            except:
-                pass    
+        # Clean up ZMQ resources
+        self.services.close()
 
         # Exit the application
         self.window.quit()       
         
+    def clear_display(self):
+        """Remove the shown image from the frame"""
+        self.image_label.configure(image='')
+        self.image_label.image = None
+        #nothing for a window resize or a pending refine to redraw
+        self.display_source = None
+        self.display_pyramid = None
+
     def update_tip(self, new_text):
         self.tip_label.config(text=new_text)
         
     def apply_grayscale(self):
         # Check if an image is loaded
-        if not hasattr(self, 'current_image') or self.current_image is None:
+        if self.is_loading():
+            return
+        if not self.has_image():
             tk.messagebox.showwarning("Warning", "No image to apply filter to!")
             return
             
@@ -545,65 +2920,23 @@ class ImageViewer():
         if not self.filters_applied and self.original_image is None:
             self.original_image = self.current_image.copy()
         
-        try:
-            # Try to use ZMQ for grayscale conversion
-            if self.init_zmq():
-                # Convert image to base64
-                buffer = io.BytesIO()
-                self.current_image.save(buffer, format='PNG')
-                img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                
-                # Create request
-                request = {
-                    "command": "grayscale",
-                    "image": img_base64
-                }
-                
-                # Send request
-                print("Sending grayscale request to ZMQ server...")
-                self.zmq_socket.send_string(json.dumps(request))
-                
-                try:
-                    # Receive response
-                    response_json = self.zmq_socket.recv_string()
-                    response = json.loads(response_json)
-                    
-                    if response.get("status") == "success":
-                        # Process the successful response
-                        img_data = base64.b64decode(response.get("image"))
-                        grayscale_image = Image.open(io.BytesIO(img_data))
-                        print("Successfully processed image via ZMQ")
-                    else:
-                        # Fall back to local processing
-                        print(f"ZMQ server error: {response.get('error')}")
-                        grayscale_image = self.current_image.convert('L').convert('RGB')
-                except zmq.error.Again:
-                    # Timeout - fall back to local processing
-                    print("ZMQ timeout - using local processing")
-                    grayscale_image = self.current_image.convert('L').convert('RGB')
-            else:
-                # ZMQ initialization failed - use local processing
-                print("ZMQ unavailable - using local processing")
-                grayscale_image = self.current_image.convert('L').convert('RGB')
-        except Exception as e:
-            # Any other error - use local processing
-            print(f"Error in grayscale processing: {e}")
-            grayscale_image = self.current_image.convert('L').convert('RGB')
-        
-        # Update the image
-        self.current_image = grayscale_image
-        self.filters_applied = True
-        
-        # Update the display
-        frame_width = self.main_frame.winfo_width()
-        frame_height = self.main_frame.winfo_height()
-        self.resize_image(self.current_image, frame_width, frame_height)
-        
-        # Update the tip
-        self.update_tip("Applied grayscale filter to image")
+        # Try to use ZMQ for grayscale conversion
+        request = {
+            "command": "grayscale"
+        }
+        self.submit_edit(
+            "grayscale",
+            request,
+            lambda image: self.point_ops.apply(image, [("grayscale", None)]),
+            "Applied grayscale filter to image",
+            update_properties=False,
+            edit=("grayscale", None)
+        )
         
     def remove_filters(self):
         # Check if an image is loaded and filters have been applied
+        if self.is_loading():
+            return
         if not hasattr(self, 'original_image') or self.original_image is None:
             tk.messagebox.showwarning("Warning", "No original image to restore!")
             return
@@ -612,22 +2945,25 @@ class ImageViewer():
             self.update_tip("No filters have been applied to remove")
             return
             
-        # Restore the original image
-        self.current_image = self.original_image.copy()
-        self.filters_applied = False
-        
-        # Update the display
-        frame_width = self.main_frame.winfo_width()
-        frame_height = self.main_frame.winfo_height()
-        self.resize_image(self.current_image, frame_width, frame_height)
-        
-        # Update the tip
-        self.update_tip("All filters removed, original image restored")
+        def restored():
+            self.filters_applied = False
+
+            # Update the display
+            self.show_current_image()
+
+            # Update the tip
+            self.update_tip("All filters removed, original image restored")
+
+        # Restore the original image, dropping any edit still being processed.
+        # Images are never modified in place so there is no need to copy it
+        self.restore_image(self.original_image, restored)
 
     def open_resize_dialog(self):
         """Open a dialog to resize the image"""
         # Check if an image is loaded
-        if not hasattr(self, 'current_image') or self.current_image is None:
+        if self.is_loading():
+            return
+        if not self.has_image():
             tk.messagebox.showwarning("Warning", "No image to resize!")
             return
         
@@ -640,7 +2976,7 @@ class ImageViewer():
         resize_dialog.grab_set()
         
         # Get current image dimensions
-        img_width, img_height = self.current_image.size
+        img_width, img_height = self.edit_graph.size()
         
         # Create frame for dimension inputs
         dim_frame = tk.Frame(resize_dialog, padx=20, pady=20)
@@ -733,7 +3069,7 @@ class ImageViewer():
 
     def resize_image_with_service(self, width, height, maintain_aspect=True):
         """Resize the image using the ZMQ service or fallback to local processing"""
-        if not hasattr(self, 'current_image') or self.current_image is None:
+        if not self.has_image():
             return
         
         # Store original image if not already saved
@@ -742,73 +3078,27 @@ class ImageViewer():
         
         self.update_tip("Processing: Resizing image...")
         
-        try:
-            # Try to use ZMQ for resizing
-            if self.init_scaling_zmq():
-                # Convert image to base64
-                buffer = io.BytesIO()
-                self.current_image.save(buffer, format='PNG')
-                img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                
-                # Create request
-                request = {
-                    "command": "resize",
-                    "image": img_base64,
-                    "width": width,
-                    "height": height,
-                    "maintain_aspect": maintain_aspect
-                }
-                
-                # Send request
-                print("Sending resize request to ZMQ server...")
-                self.scaling_zmq_socket.send_string(json.dumps(request))
-                
-                try:
-                    # Receive response
-                    response_json = self.scaling_zmq_socket.recv_string()
-                    response = json.loads(response_json)
-                    
-                    if response.get("status") == "success":
-                        # Process the successful response
-                        img_data = base64.b64decode(response.get("image"))
-                        resized_image = Image.open(io.BytesIO(img_data))
-                        print(f"Successfully resized image via ZMQ to {response.get('width')}x{response.get('height')}")
-                    else:
-                        # Fall back to local processing
-                        print(f"ZMQ server error: {response.get('error')}")
-                        resized_image = self.current_image.resize((width, height), Image.Resampling.LANCZOS)
-                except zmq.error.Again:
-                    # Timeout - fall back to local processing
-                    print("ZMQ timeout - using local processing")
-                    resized_image = self.current_image.resize((width, height), Image.Resampling.LANCZOS)
-            else:
-                # ZMQ initialization failed - use local processing
-                print("ZMQ unavailable - using local processing")
-                resized_image = self.current_image.resize((width, height), Image.Resampling.LANCZOS)
-        except Exception as e:
-            # Any other error - use local processing
-            print(f"Error in resize processing: {e}")
-            resized_image = self.current_image.resize((width, height), Image.Resampling.LANCZOS)
-        
-        # Update the image
-        self.current_image = resized_image
-        self.filters_applied = True
-
-        # Update the display
-        frame_width = self.main_frame.winfo_width()
-        frame_height = self.main_frame.winfo_height()
-        self.resize_image(self.current_image, frame_width, frame_height)
-        
-        # Update the tip
-        self.update_tip(f"Resized image to {width}x{height} pixels")
-        
-        # Update image properties
-        self.update_image_properties()
+        # Try to use ZMQ for resizing
+        request = {
+            "command": "resize",
+            "width": width,
+            "height": height,
+            "maintain_aspect": maintain_aspect
+        }
+        self.submit_edit(
+            "scaling",
+            request,
+            lambda image: image.resize((width, height), Image.Resampling.LANCZOS),
+            f"Resized image to {width}x{height} pixels",
+            edit=("resize", (width, height))
+        )
 
     def open_crop_dialog(self):
         """Open a dialog to crop the image"""
         # Check if an image is loaded
-        if not hasattr(self, 'current_image') or self.current_image is None:
+        if self.is_loading():
+            return
+        if not self.has_image():
             tk.messagebox.showwarning("Warning", "No image to crop!")
             return
         
@@ -819,7 +3109,7 @@ class ImageViewer():
         crop_dialog.grab_set()
         
         # Get current image dimensions
-        img_width, img_height = self.current_image.size
+        img_width, img_height = self.edit_graph.size()
         
         # Create a frame to hold everything
         main_frame = tk.Frame(crop_dialog, padx=20, pady=20)
@@ -839,7 +3129,8 @@ class ImageViewer():
         canvas.pack(pady=10)
         
         # Scale the image for display
-        display_image = self.current_image.resize((display_width, display_height), Image.Resampling.LANCZOS)
+        display_image = self.preview_current_image(display_width, display_height)
+        display_image = display_image.resize((display_width, display_height), Image.Resampling.LANCZOS)
         tk_image = ImageTk.PhotoImage(display_image)
         
         # Store the image to prevent garbage collection
@@ -969,7 +3260,7 @@ class ImageViewer():
 
     def crop_image_with_service(self, left, top, right, bottom):
         """Crop the image using the ZMQ service or fallback to local processing"""
-        if not hasattr(self, 'current_image') or self.current_image is None:
+        if not self.has_image():
             return
         
         # Store original image if not already saved
@@ -978,96 +3269,71 @@ class ImageViewer():
         
         self.update_tip("Processing: Cropping image...")
         
-        try:
-            # Try to use ZMQ for cropping
-            if self.init_scaling_zmq():
-                # Convert image to base64
-                buffer = io.BytesIO()
-                self.current_image.save(buffer, format='PNG')
-                img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                
-                # Create request
-                request = {
-                    "command": "crop",
-                    "image": img_base64,
-                    "left": left,
-                    "top": top,
-                    "right": right,
-                    "bottom": bottom
-                }
-                
-                # Send request
-                print("Sending crop request to ZMQ server...")
-                self.scaling_zmq_socket.send_string(json.dumps(request))
-                
-                try:
-                    # Receive response
-                    response_json = self.scaling_zmq_socket.recv_string()
-                    response = json.loads(response_json)
-                    
-                    if response.get("status") == "success":
-                        # Process the successful response
-                        img_data = base64.b64decode(response.get("image"))
-                        cropped_image = Image.open(io.BytesIO(img_data))
-                        print(f"Successfully cropped image via ZMQ to {response.get('width')}x{response.get('height')}")
-                    else:
-                        # Fall back to local processing
-                        print(f"ZMQ server error: {response.get('error')}")
-                        cropped_image = self.current_image.crop((left, top, right, bottom))
-                except zmq.error.Again:
-                    # Timeout - fall back to local processing
-                    print("ZMQ timeout - using local processing")
-                    cropped_image = self.current_image.crop((left, top, right, bottom))
-            else:
-                # ZMQ initialization failed - use local processing
-                print("ZMQ unavailable - using local processing")
-                cropped_image = self.current_image.crop((left, top, right, bottom))
-        except Exception as e:
-            # Any other error - use local processing
-            print(f"Error in crop processing: {e}")
-            cropped_image = self.current_image.crop((left, top, right, bottom))
-        
-        # Update the image
-        self.current_image = cropped_image
-        self.filters_applied = True
-        
-        # Update the display (changed from resize_display_image to resize_image)
-        frame_width = self.main_frame.winfo_width()
-        frame_height = self.main_frame.winfo_height()
-        self.resize_image(self.current_image, frame_width, frame_height)
-        
-        # Update the tip
+        # Try to use ZMQ for cropping
+        request = {
+            "command": "crop",
+            "left": left,
+            "top": top,
+            "right": right,
+            "bottom": bottom
+        }
         crop_width = right - left
         crop_height = bottom - top
-        self.update_tip(f"Cropped image to {crop_width}x{crop_height} pixels")
-        
-        # Update image properties
-        self.update_image_properties()
+        self.submit_edit(
+            "scaling",
+            request,
+            lambda image: image.crop((left, top, right, bottom)),
+            f"Cropped image to {crop_width}x{crop_height} pixels",
+            edit=("crop", (left, top, right, bottom))
+        )
 
     def revert_to_original(self):
         """Revert the image to its original size"""
+        if self.is_loading():
+            return
         if not hasattr(self, 'original_image') or self.original_image is None:
             tk.messagebox.showwarning("Warning", "No original image to revert to!")
             return
         
-        # Restore the original image
-        self.current_image = self.original_image.copy()
-        
-        # Update the display (changed from resize_display_image to resize_image)
-        frame_width = self.main_frame.winfo_width()
-        frame_height = self.main_frame.winfo_height()
-        self.resize_image(self.current_image, frame_width, frame_height)
-        
-        # Update the tip
-        img_width, img_height = self.current_image.size
-        self.update_tip(f"Reverted to original size: {img_width}x{img_height} pixels")
+        def restored():
+            # Update the display (changed from resize_display_image to resize_image)
+            self.show_current_image()
 
-        self.update_image_properties()
+            # Update the tip
+            img_width, img_height = self.edit_graph.size()
+            self.update_tip(f"Reverted to original size: {img_width}x{img_height} pixels")
+
+            self.update_image_properties()
+
+        # Restore the original image, dropping any edit still being processed.
+        # Images are never modified in place so there is no need to copy it
+        self.restore_image(self.original_image, restored)
+
+    def make_preview_proxy(self, size):
+        """Downscale the current image to size for dialog previews"""
+        return self.preview_current_image(*size).resize(size, Image.Resampling.LANCZOS)
+
+    def make_throttled(self, callback, delay=30):
+        """Wrap callback so a burst of calls runs it once with the latest arguments"""
+        state = {"args": None, "job": None}
+
+        def run():
+            state["job"] = None
+            callback(*state["args"])
+
+        def throttled(*args):
+            state["args"] = args
+            if state["job"] is None:
+                state["job"] = self.window.after(delay, run)
+
+        return throttled
 
     def open_brightness_dialog(self):
         """Open dialog to adjust image brightness"""
         # Check if an image is loaded
-        if not hasattr(self, 'current_image') or self.current_image is None:
+        if self.is_loading():
+            return
+        if not self.has_image():
             tk.messagebox.showwarning("Warning", "No image to adjust!")
             return
         
@@ -1080,11 +3346,9 @@ class ImageViewer():
         brightness_dialog.transient(self.window)
         brightness_dialog.grab_set()
         
-        # Store original image for preview
-        if not hasattr(self, 'original_for_preview') or self.original_for_preview is None:
-            self.original_for_preview = self.current_image.copy()
-        else:
-            self.original_for_preview = self.current_image.copy()
+        # Downscale once to a proxy, slider previews only ever touch the proxy
+        preview_size = (300, 200)
+        self.original_for_preview = self.make_preview_proxy(preview_size)
         
         # Using a simpler pack layout
         main_frame = tk.Frame(brightness_dialog)
@@ -1094,8 +3358,7 @@ class ImageViewer():
         preview_label = tk.Label(main_frame, text="Preview:")
         preview_label.pack(anchor="w", pady=(0, 5))
         
-        preview_size = (300, 200)
-        preview_img = self.original_for_preview.resize(preview_size, Image.Resampling.LANCZOS)
+        preview_img = self.original_for_preview
         preview_photo = ImageTk.PhotoImage(preview_img)
         
         preview_canvas = tk.Canvas(main_frame, width=preview_size[0], height=preview_size[1], bg='white')
@@ -1107,15 +3370,9 @@ class ImageViewer():
         slider_label = tk.Label(main_frame, text="Brightness: 1.00x")
         slider_label.pack(anchor="w", pady=(10, 5))
         
-        def on_slider_change(val):
-            factor = float(val) / 50.0
-            slider_label.config(text=f"Brightness: {factor:.2f}x")
-            
-            # Update preview
+        def update_preview(factor):
             try:
-                enhancer = ImageEnhance.Brightness(self.original_for_preview)
-                adjusted = enhancer.enhance(factor)
-                adjusted_small = adjusted.resize(preview_size, Image.Resampling.LANCZOS)
+                adjusted_small = self.point_ops.apply(self.original_for_preview, [("brightness", factor)])
                 
                 new_photo = ImageTk.PhotoImage(adjusted_small)
                 preview_canvas.delete("all")
@@ -1123,6 +3380,16 @@ class ImageViewer():
                 preview_canvas.image = new_photo
             except Exception as e:
                 pass  # Silently handle errors
+
+        # Only the latest slider value gets rendered
+        throttled_preview = self.make_throttled(update_preview)
+
+        def on_slider_change(val):
+            factor = float(val) / 50.0
+            slider_label.config(text=f"Brightness: {factor:.2f}x")
+            
+            # Update preview
+            throttled_preview(factor)
         
         slider = tk.Scale(main_frame, from_=0, to=100, orient=tk.HORIZONTAL, command=on_slider_change)
         slider.set(50)  # Default middle value
@@ -1154,7 +3421,9 @@ class ImageViewer():
     def open_contrast_dialog(self):
         """Open dialog to adjust image contrast"""
         # Check if an image is loaded
-        if not hasattr(self, 'current_image') or self.current_image is None:
+        if self.is_loading():
+            return
+        if not self.has_image():
             tk.messagebox.showwarning("Warning", "No image to adjust!")
             return
         
@@ -1167,11 +3436,9 @@ class ImageViewer():
         contrast_dialog.transient(self.window)
         contrast_dialog.grab_set()
         
-        # Store original image for preview
-        if not hasattr(self, 'original_for_preview') or self.original_for_preview is None:
-            self.original_for_preview = self.current_image.copy()
-        else:
-            self.original_for_preview = self.current_image.copy()
+        # Downscale once to a proxy, slider previews only ever touch the proxy
+        preview_size = (300, 200)
+        self.original_for_preview = self.make_preview_proxy(preview_size)
         
         # Use a ScrolledFrame if the image is very tall
         main_frame = tk.Frame(contrast_dialog)
@@ -1181,9 +3448,7 @@ class ImageViewer():
         preview_label = tk.Label(main_frame, text="Preview:")
         preview_label.pack(anchor="w", pady=(0, 5))
         
-        # Limit preview size
-        preview_size = (300, 200)  # Fixed preview size regardless of image dimensions
-        preview_img = self.original_for_preview.resize(preview_size, Image.Resampling.LANCZOS)
+        preview_img = self.original_for_preview
         preview_photo = ImageTk.PhotoImage(preview_img)
         
         preview_canvas = tk.Canvas(main_frame, width=preview_size[0], height=preview_size[1], bg='white')
@@ -1195,15 +3460,9 @@ class ImageViewer():
         slider_label = tk.Label(main_frame, text="Contrast: 1.00x")
         slider_label.pack(anchor="w", pady=(10, 5))
         
-        def on_slider_change(val):
-            factor = float(val) / 50.0
-            slider_label.config(text=f"Contrast: {factor:.2f}x")
-            
-            # Update preview
+        def update_preview(factor):
             try:
-                enhancer = ImageEnhance.Contrast(self.original_for_preview)
-                adjusted = enhancer.enhance(factor)
-                adjusted_small = adjusted.resize(preview_size, Image.Resampling.LANCZOS)
+                adjusted_small = self.point_ops.apply(self.original_for_preview, [("contrast", factor)])
                 
                 new_photo = ImageTk.PhotoImage(adjusted_small)
                 preview_canvas.delete("all")
@@ -1211,6 +3470,16 @@ class ImageViewer():
                 preview_canvas.image = new_photo
             except Exception as e:
                 pass  # Silently handle errors
+
+        # Only the latest slider value gets rendered
+        throttled_preview = self.make_throttled(update_preview)
+
+        def on_slider_change(val):
+            factor = float(val) / 50.0
+            slider_label.config(text=f"Contrast: {factor:.2f}x")
+            
+            # Update preview
+            throttled_preview(factor)
         
         slider = tk.Scale(main_frame, from_=0, to=100, orient=tk.HORIZONTAL, command=on_slider_change)
         slider.set(50)  # Default middle value
@@ -1241,7 +3510,7 @@ class ImageViewer():
 
     def adjust_brightness_with_service(self, factor):
         """Adjust image brightness using ZMQ service or local processing"""
-        if not hasattr(self, 'current_image') or self.current_image is None:
+        if not self.has_image():
             return
         
         # Store original image if not already saved
@@ -1250,74 +3519,23 @@ class ImageViewer():
         
         self.update_tip("Processing: Adjusting brightness...")
         
-        try:
-            # Try to use ZMQ for brightness adjustment
-            if self.init_adjustments_zmq():
-                # Convert image to base64
-                buffer = io.BytesIO()
-                self.current_image.save(buffer, format=getattr(self.current_image, 'format', 'PNG') or 'PNG')
-                img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                
-                # Create request
-                request = {
-                    "command": "brightness",
-                    "image": img_base64,
-                    "factor": factor
-                }
-                
-                # Send request
-                print("Sending brightness request to ZMQ server...")
-                self.adjustments_zmq_socket.send_string(json.dumps(request))
-                
-                try:
-                    # Receive response
-                    response_json = self.adjustments_zmq_socket.recv_string()
-                    response = json.loads(response_json)
-                    
-                    if response.get("status") == "success":
-                        # Process the successful response
-                        img_data = base64.b64decode(response.get("image"))
-                        adjusted_image = Image.open(io.BytesIO(img_data))
-                        print(f"Successfully adjusted brightness via ZMQ")
-                    else:
-                        # Fall back to local processing
-                        print(f"ZMQ server error: {response.get('error')}")
-                        enhancer = ImageEnhance.Brightness(self.current_image)
-                        adjusted_image = enhancer.enhance(factor)
-                except zmq.error.Again:
-                    # Timeout - fall back to local processing
-                    print("ZMQ timeout - using local processing")
-                    enhancer = ImageEnhance.Brightness(self.current_image)
-                    adjusted_image = enhancer.enhance(factor)
-            else:
-                # ZMQ initialization failed - use local processing
-                print("ZMQ unavailable - using local processing")
-                enhancer = ImageEnhance.Brightness(self.current_image)
-                adjusted_image = enhancer.enhance(factor)
-        except Exception as e:
-            # Any other error - use local processing
-            print(f"Error in brightness processing: {e}")
-            enhancer = ImageEnhance.Brightness(self.current_image)
-            adjusted_image = enhancer.enhance(factor)
-        
-        # Update the image
-        self.current_image = adjusted_image
-        self.filters_applied = True
-        
-        # Update the display
-        frame_width = self.main_frame.winfo_width()
-        frame_height = self.main_frame.winfo_height()
-        self.resize_image(self.current_image, frame_width, frame_height)
-        
-        # Update the tip
-        self.update_tip(f"Adjusted brightness to {factor:.2f}")
-        
-        # Update image properties
-        self.update_image_properties()
+        # Try to use ZMQ for brightness adjustment
+        request = {
+            "command": "brightness",
+            "factor": factor
+        }
+        self.submit_edit(
+            "adjustments",
+            request,
+            lambda image: self.point_ops.apply(image, [("brightness", factor)]),
+            f"Adjusted brightness to {factor:.2f}",
+            image_format=getattr(self.edit_graph.source, 'format', 'PNG') or 'PNG',
+            edit=("brightness", factor)
+        )
 
     def adjust_contrast_with_service(self, factor):
         """Adjust image contrast using ZMQ service or local processing"""
-        if not hasattr(self, 'current_image') or self.current_image is None:
+        if not self.has_image():
             return
         
         # Store original image if not already saved
@@ -1326,95 +3544,56 @@ class ImageViewer():
         
         self.update_tip("Processing: Adjusting contrast...")
         
-        try:
-            # Try to use ZMQ for contrast adjustment
-            if self.init_adjustments_zmq():
-                # Convert image to base64
-                buffer = io.BytesIO()
-                self.current_image.save(buffer, format=getattr(self.current_image, 'format', 'PNG') or 'PNG')
-                img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                
-                # Create request
-                request = {
-                    "command": "contrast",
-                    "image": img_base64,
-                    "factor": factor
-                }
-                
-                # Send request
-                print("Sending contrast request to ZMQ server...")
-                self.adjustments_zmq_socket.send_string(json.dumps(request))
-                
-                try:
-                    # Receive response
-                    response_json = self.adjustments_zmq_socket.recv_string()
-                    response = json.loads(response_json)
-                    
-                    if response.get("status") == "success":
-                        # Process the successful response
-                        img_data = base64.b64decode(response.get("image"))
-                        adjusted_image = Image.open(io.BytesIO(img_data))
-                        print(f"Successfully adjusted contrast via ZMQ")
-                    else:
-                        # Fall back to local processing
-                        print(f"ZMQ server error: {response.get('error')}")
-                        enhancer = ImageEnhance.Contrast(self.current_image)
-                        adjusted_image = enhancer.enhance(factor)
-                except zmq.error.Again:
-                    # Timeout - fall back to local processing
-                    print("ZMQ timeout - using local processing")
-                    enhancer = ImageEnhance.Contrast(self.current_image)
-                    adjusted_image = enhancer.enhance(factor)
-            else:
-                # ZMQ initialization failed - use local processing
-                print("ZMQ unavailable - using local processing")
-                enhancer = ImageEnhance.Contrast(self.current_image)
-                adjusted_image = enhancer.enhance(factor)
-        except Exception as e:
-            # Any other error - use local processing
-            print(f"Error in contrast processing: {e}")
-            enhancer = ImageEnhance.Contrast(self.current_image)
-            adjusted_image = enhancer.enhance(factor)
-        
-        # Update the image
-        self.current_image = adjusted_image
-        self.filters_applied = True
-        
-        # Update the display
-        frame_width = self.main_frame.winfo_width()
-        frame_height = self.main_frame.winfo_height()
-        self.resize_image(self.current_image, frame_width, frame_height)
-        
-        # Update the tip
-        self.update_tip(f"Adjusted contrast to {factor:.2f}")
-        
-        # Update image properties
-        self.update_image_properties()    
+        # Try to use ZMQ for contrast adjustment
+        request = {
+            "command": "contrast",
+            "factor": factor
+        }
+        self.submit_edit(
+            "adjustments",
+            request,
+            lambda image: self.point_ops.apply(image, [("contrast", factor)]),
+            f"Adjusted contrast to {factor:.2f}",
+            image_format=getattr(self.edit_graph.source, 'format', 'PNG') or 'PNG',
+            edit=("contrast", factor)
+        )
 
     def update_image_properties(self):
-        """Update the image properties panel after image modifications"""
-        if hasattr(self, 'current_image') and self.current_image:
-            try:
-                # Save the current image to a temporary file
-                temp_path = "temp_image.png"
-                self.current_image.save(temp_path)
-                
-                # Get properties using the microservice
-                img_data = self.image_prop.extract_data(temp_path)
-                
-                # Update properties panel
-                if img_data:
-                    self.update_properties(img_data)
-                    
-                # Remove the temporary file
-                import os
-                try:
-                    os.remove(temp_path)
-                except:
-                    pass
-                    
-            except Exception as e:
-                print(f"Error updating image properties: {e}")    
+        """Update the image properties panel after image modifications
+
+        Calls within a short window are coalesced, and the properties are
+        computed from the in-memory image in the background.
+        """
+        if self.properties_timer is not None:
+            self.window.after_cancel(self.properties_timer)
+        self.properties_timer = self.window.after(self.properties_delay, self._refresh_image_properties)
+
+    def _refresh_image_properties(self):
+        self.properties_timer = None
+        if not self.has_image():
+            return
+
+        image_format = self.image_prop.image_format or 'PNG'
+        if self.edit_graph.ops:
+            # Don't render pending edits at full resolution just for this
+            image = self.preview_current_image(512, 512)
+            size = self.edit_graph.size()
+        else:
+            image = self.edit_graph.source
+            size = None
+
+        def work():
+            return self.image_prop.extract_image_data(image, image_format, size)
+
+        def done(img_data):
+            # Update properties panel
+            if img_data:
+                self.update_properties(img_data)
+
+        def failed(e):
+            print(f"Error updating image properties: {e}")
+
+        self.jobs.submit("properties", work, done, failed)
 
     def open_simple_brightness_dialog(self):
         """Simplified test dialog"""
@@ -1440,7 +3619,7 @@ class ImageViewer():
 
     # Also add this test function
     def test_pil_enhance(self):
-        if not hasattr(self, 'current_image') or self.current_image is None:
+        if not self.has_image():
             print("No image loaded")
             return
             
@@ -1452,9 +3631,7 @@ class ImageViewer():
             
             # Show the enhanced image temporarily
             self.current_image = enhanced
-            frame_width = self.main_frame.winfo_width()
-            frame_height = self.main_frame.winfo_height()
-            self.resize_image(self.current_image, frame_width, frame_height)
+            self.show_current_image()
         except Exception as e:
             print(f"PIL enhancement error: {e}")
 
@@ -1488,5 +3665,9 @@ class ImageViewer():
 
 
 if __name__ == "__main__":
-    image_viewer = ImageViewer()
-    image_viewer.run()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        # Any arguments mean a headless batch run
+        run_batch(sys.argv[1:])
+    else:
+        image_viewer = ImageViewer()
+        image_viewer.run()
\ No newline at end of file
@@ -0,0 +1,487 @@
+"""Reference implementations of the grayscale, scaling and adjustments services
+
+Each service is a broker process with a ROUTER socket facing the clients and a
+pool of worker processes behind it. Idle workers announce themselves and
+requests only go to an idle worker, so a slow request never holds up others
+while a worker is free. Workers speak every wire protocol the viewer uses: the
+hello negotiation, v1 JSON with a base64 PNG, v2 header + pixel frames (raw or
+compressed with one of the negotiated payload codecs) and v3 shared memory.
+Every service also runs "pipeline" requests, which apply an ordered list of
+operations to one image and return only the final result:
+
+    {"command": "pipeline", "operations": [{"command": "crop", ...}, ...]}
+
+    python server.py grayscale --workers 4
+    python server.py all
+
+Sessions keep an image on the service so later edits send only parameters.
+"session_open" uploads the image under a client chosen session ID, any
+operation (or pipeline) carrying that "session" then edits the stored image
+in place and returns it only if "return_image" is set, and "session_fetch"
+returns it. Sessions expire after --session-ttl seconds unused, or when a
+worker's sessions exceed --session-mb. The broker sends every request of a
+session to the worker holding it.
+
+Result segments of v3 replies belong to the client once it has read them, but
+a client that timed out never does, so the broker unlinks every segment it
+passed on once it is --segment-ttl seconds old.
+
+A "Q" message (sent by the viewer on exit) is answered and shuts the service
+down once the requests in progress are finished, unless --ignore-quit is given.
+"""
+import argparse
+import base64
+import io
+import json
+import multiprocessing
+import os
+import signal
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from multiprocessing import shared_memory
+
+import zmq
+from PIL import Image
+
+from imaging import (PointOpEngine, attach_shared_image, share_image, encode_payload, decode_payload,
+                     available_codecs, codec_family, image_nbytes, PROTOCOL_JSON, PROTOCOL_BINARY, PROTOCOL_SHM)
+
+SESSION_COMMANDS = ("session_open", "session_fetch", "session_close")
+SERVICES = {
+    "grayscale": ("tcp://*:5555", ("grayscale", "pipeline") + SESSION_COMMANDS),
+    "scaling": ("tcp://*:5556", ("resize", "crop", "pipeline") + SESSION_COMMANDS),
+    "adjustments": ("tcp://*:5557", ("brightness", "contrast", "pipeline") + SESSION_COMMANDS)
+}
+# Any service runs a pipeline, or a session edit, of any single operation
+PIPELINE_COMMANDS = ("grayscale", "resize", "crop", "brightness", "contrast")
+PROTOCOLS = (PROTOCOL_SHM, PROTOCOL_BINARY, PROTOCOL_JSON)
+CODECS = available_codecs()
+
+READY = b"READY"
+STOP = b"STOP"
+
+class RequestError(Exception):
+    """A request the service can't process, reported back to the client"""
+
+class Terminated(Exception):
+    """Raised in the main thread when the process gets SIGTERM"""
+
+def raise_terminated(signum, frame):
+    # Only once, a second SIGTERM must not interrupt the cleanup
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise Terminated()
+
+def apply_command(request, image, point_ops):
+    """Apply one request of the service schemas to image"""
+    command = request["command"]
+    if command == "grayscale":
+        return point_ops.apply(image, [("grayscale", None)])
+
+    if command == "resize":
+        width, height = int(request["width"]), int(request["height"])
+        if width < 1 or height < 1:
+            raise RequestError(f"Invalid size {width}x{height}")
+        if request.get("maintain_aspect"):
+            # Fit within width x height
+            scale = min(width / image.width, height / image.height)
+            width = max(1, round(image.width * scale))
+            height = max(1, round(image.height * scale))
+        return image.resize((width, height), Image.Resampling.LANCZOS)
+
+    if command == "crop":
+        box = tuple(int(request[key]) for key in ("left", "top", "right", "bottom"))
+        if not (0 <= box[0] < box[2] <= image.width and 0 <= box[1] < box[3] <= image.height):
+            raise RequestError(f"Crop box {box} is outside the {image.width}x{image.height} image")
+        return image.crop(box)
+
+    if command in ("brightness", "contrast"):
+        operation = (command, float(request["factor"]))
+        if command == "contrast" and request.get("mean") is not None:
+            operation += (int(request["mean"]),)
+        return point_ops.apply(image, [operation])
+
+    if command == "pipeline":
+        operations = request.get("operations")
+        if not isinstance(operations, list) or not operations:
+            raise RequestError("A pipeline needs a list of operations")
+        for operation in operations:
+            if not isinstance(operation, dict) or operation.get("command") not in PIPELINE_COMMANDS:
+                raise RequestError(f"Invalid pipeline operation: {operation}")
+            image = apply_command(operation, image, point_ops)
+        return image
+
+    raise RequestError(f"Unknown command: {command}")
+
+class SessionStore():
+    """Images kept by one worker between the requests of a session"""
+    def __init__(self, ttl=600, max_bytes=512 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.bytes = 0
+
+    def get(self, session):
+        self.expire()
+        if session not in self.images:
+            return None
+        self.images.move_to_end(session)
+        image, _ = self.images[session]
+        self.images[session] = (image, time.monotonic())
+        return image
+
+    def put(self, session, image):
+        self.drop(session)
+        self.images[session] = (image, time.monotonic())
+        self.bytes += image_nbytes(image)
+        # Least recently used sessions go first
+        while self.bytes > self.max_bytes and len(self.images) > 1:
+            self.drop(next(iter(self.images)))
+
+    def drop(self, session):
+        if session in self.images:
+            image, _ = self.images.pop(session)
+            self.bytes -= image_nbytes(image)
+
+    def expire(self):
+        now = time.monotonic()
+        for session in [s for s, (_, used) in self.images.items() if now - used > self.ttl]:
+            self.drop(session)
+
+def read_image(request, frames):
+    """Return the image sent with a request and a cleanup function
+
+    A v3 image stays backed by the client's segment until cleanup is called.
+    """
+    version = request.get("version", PROTOCOL_JSON)
+    if version == PROTOCOL_SHM:
+        image, segment = attach_shared_image(request)
+        return image, segment.close
+    if version == PROTOCOL_BINARY:
+        if len(frames) < 2:
+            raise RequestError("Missing pixel frame")
+        return decode_payload(request, frames[1]), lambda: None
+    if "image" not in request:
+        raise RequestError("Missing image")
+    return Image.open(io.BytesIO(base64.b64decode(request["image"]))), lambda: None
+
+def image_reply(request, image, header):
+    """Header and frames returning image in the request's protocol and codec"""
+    version = request.get("version", PROTOCOL_JSON)
+    if version == PROTOCOL_SHM:
+        geometry, segment = share_image(image, untrack=True)
+        segment.close()
+        return dict(header, **geometry), []
+    if version == PROTOCOL_BINARY:
+        codec = request.get("reply_codec") or request.get("codec") or "raw"
+        if codec_family(codec) not in CODECS:
+            codec = "raw"
+        geometry, payload = encode_payload(image, codec)
+        return dict(header, **geometry), [payload]
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return dict(header, image=base64.b64encode(buffer.getvalue()).decode('utf-8')), []
+
+def handle_session(request, frames, point_ops, sessions):
+    """Process a request of a session, returning the reply header and frames"""
+    command = request["command"]
+    session = str(request["session"])
+    header = {"status": "success", "session": session}
+
+    if command == "session_close":
+        sessions.drop(session)
+        return header, []
+
+    if command == "session_open":
+        image, cleanup = read_image(request, frames)
+        try:
+            # Keep a private copy, a v3 image still lives in the client's segment
+            image = image.copy()
+        finally:
+            cleanup()
+        sessions.put(session, image)
+        return dict(header, size=list(image.size), mode=image.mode), []
+
+    image = sessions.get(session)
+    if image is None:
+        return {"status": "error", "error": f"Unknown session {session}", "session_expired": True}, []
+
+    if command != "session_fetch":
+        image = apply_command(request, image, point_ops)
+        sessions.put(session, image)
+        if not request.get("return_image"):
+            return dict(header, size=list(image.size), mode=image.mode), []
+    return image_reply(request, image, header)
+
+def handle(frames, commands, point_ops, sessions=None):
+    """Process one request and return the reply frames"""
+    started = time.perf_counter()
+    try:
+        request = json.loads(frames[0])
+    except ValueError:
+        return [json.dumps({"status": "error", "error": "Request is not JSON"}).encode('utf-8')]
+
+    command = request.get("command")
+    if command == "hello":
+        offered = request.get("protocols") or [PROTOCOL_JSON]
+        protocol = next((p for p in PROTOCOLS if p in offered), PROTOCOL_JSON)
+        codecs = [codec for codec in CODECS if codec in (request.get("codecs") or ["raw"])]
+        return [json.dumps({"status": "success", "protocol": protocol, "commands": list(commands),
+                            "codecs": codecs}).encode('utf-8')]
+
+    def reply(header, *extra):
+        header = dict(header, server_ms=(time.perf_counter() - started) * 1000)
+        return [json.dumps(header).encode('utf-8')] + list(extra)
+
+    in_session = request.get("session") is not None and sessions is not None
+    if command not in commands and not (in_session and command in PIPELINE_COMMANDS):
+        return reply({"status": "error", "error": f"Unsupported command: {command}"})
+
+    version = request.get("version", PROTOCOL_JSON)
+    try:
+        if in_session:
+            header, extra = handle_session(request, frames, point_ops, sessions)
+            return reply(header, *extra)
+        if command in SESSION_COMMANDS:
+            raise RequestError(f"{command} needs a session")
+
+        image, cleanup = read_image(request, frames)
+        try:
+            # Results can share the client's buffer (crop), copy before closing
+            result = apply_command(request, image, point_ops)
+            if version == PROTOCOL_SHM:
+                result = result.copy()
+        finally:
+            del image
+            cleanup()
+        header, extra = image_reply(request, result, {"status": "success"})
+        return reply(header, *extra)
+    except RequestError as e:
+        return reply({"status": "error", "error": str(e)})
+    except Exception as e:
+        print(f"Error processing {command}: {e}")
+        return reply({"status": "error", "error": f"{type(e).__name__}: {e}"})
+
+def worker_main(backend, commands, session_ttl=600, session_bytes=512 * 1024 * 1024):
+    """Worker process loop, one request at a time"""
+    # The broker stops its workers itself, SIGTERM from it must kill outright
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    point_ops = PointOpEngine()
+    sessions = SessionStore(session_ttl, session_bytes)
+    context = zmq.Context()
+    socket = context.socket(zmq.REQ)
+    socket.connect(backend)
+    socket.send(READY)
+    try:
+        while True:
+            frames = socket.recv_multipart()
+            if frames == [STOP]:
+                break
+            # The client's envelope comes first, up to the empty delimiter
+            split = frames.index(b"")
+            socket.send_multipart(frames[:split + 1] + handle(frames[split + 1:], commands, point_ops, sessions))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        socket.close(linger=0)
+        context.term()
+
+def header_of(frame):
+    """The JSON header of a request or reply, without parsing large messages"""
+    if len(frame) > 65536 or not frame.startswith(b"{"):
+        return {}
+    try:
+        header = json.loads(frame)
+    except ValueError:
+        return {}
+    return header if isinstance(header, dict) else {}
+
+def unlink_segment(name):
+    """Free a shared memory segment unless its reader already did"""
+    try:
+        segment = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return False
+    segment.close()
+    segment.unlink()
+    return True
+
+def serve(service, bind=None, workers=None, ignore_quit=False, session_ttl=600, session_mb=512, segment_ttl=30):
+    """Run a service broker and its worker pool until "Q", Ctrl+C or SIGTERM"""
+    default_bind, commands = SERVICES[service]
+    bind = bind or default_bind
+    workers = workers or os.cpu_count() or 2
+
+    # SIGTERM stops the workers like Ctrl+C does, instead of orphaning them
+    main_thread = threading.current_thread() is threading.main_thread()
+    if main_thread:
+        previous_handler = signal.signal(signal.SIGTERM, raise_terminated)
+
+    context = None
+    backend_socket = None
+    if os.name == 'nt':
+        # No ipc transport on Windows. Workers are spawned there, so they
+        # don't inherit this process's sockets
+        context = zmq.Context()
+        backend_socket = context.socket(zmq.ROUTER)
+        backend = f"tcp://127.0.0.1:{backend_socket.bind_to_random_port('tcp://127.0.0.1')}"
+    else:
+        backend = f"ipc://{tempfile.gettempdir()}/image-{service}-{os.getpid()}.ipc"
+
+    # Workers start before anything is bound, forked workers would otherwise
+    # inherit the listening socket and keep the port after the broker dies
+    worker_args = (backend, commands, session_ttl, session_mb * 1024 * 1024)
+    processes = [multiprocessing.Process(target=worker_main, args=worker_args, daemon=True)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    idle = []
+    busy = 0
+    # Session ID -> (worker holding it, last used), and requests waiting
+    # for a busy worker that holds their session
+    owners = {}
+    waiting = {}
+    # (time, name) of the v3 result segments passed on to clients
+    segments = deque()
+    expired_check = time.monotonic()
+    stopping = False
+    listening = False
+    frontend = None
+
+    def dispatch(worker, envelope, payload):
+        nonlocal busy
+        busy += 1
+        backend_socket.send_multipart([worker, b""] + envelope + [b""] + payload)
+
+    try:
+        if backend_socket is None:
+            context = zmq.Context()
+            backend_socket = context.socket(zmq.ROUTER)
+            backend_socket.bind(backend)
+        frontend = context.socket(zmq.ROUTER)
+        frontend.bind(bind)
+        print(f"{service} service on {bind} with {workers} workers")
+
+        poller = zmq.Poller()
+        poller.register(backend_socket, zmq.POLLIN)
+        while not stopping or busy:
+            # Only take client requests while a worker is free to run them
+            if listening != (bool(idle) and not stopping):
+                listening = not listening
+                if listening:
+                    poller.register(frontend, zmq.POLLIN)
+                else:
+                    poller.unregister(frontend)
+            events = dict(poller.poll(1000))
+
+            if backend_socket in events:
+                worker, _, *message = backend_socket.recv_multipart()
+                if message != [READY]:
+                    busy -= 1
+                    split = message.index(b"")
+                    header = header_of(message[split + 1]) if len(message) > split + 1 else {}
+                    if header.get("session") is not None:
+                        owners[header["session"]] = (worker, time.monotonic())
+                    if header.get("shm"):
+                        segments.append((time.monotonic(), header["shm"]))
+                    frontend.send_multipart(message)
+                if waiting.get(worker):
+                    dispatch(worker, *waiting[worker].pop(0))
+                else:
+                    idle.append(worker)
+
+            while segments and time.monotonic() - segments[0][0] > segment_ttl:
+                if unlink_segment(segments.popleft()[1]):
+                    print("Freed a result segment the client never read")
+
+            if time.monotonic() - expired_check > 10:
+                # Forget sessions the workers will have expired
+                expired_check = time.monotonic()
+                for session in [s for s, (_, used) in owners.items() if expired_check - used > session_ttl]:
+                    del owners[session]
+
+            if frontend in events:
+                frames = frontend.recv_multipart()
+                if b"" in frames:
+                    split = frames.index(b"")
+                    envelope, payload = frames[:split], frames[split + 1:]
+                else:
+                    # A DEALER client that sent no delimiter
+                    envelope, payload = frames[:1], frames[1:]
+                if payload == [b"Q"]:
+                    frontend.send_multipart(envelope + [b"", b"Q received"])
+                    if not ignore_quit:
+                        print(f"Quit requested, stopping {service} service")
+                        stopping = True
+                    continue
+                session = header_of(payload[0]).get("session") if payload else None
+                if session is not None and session in owners:
+                    worker = owners[session][0]
+                    owners[session] = (worker, time.monotonic())
+                    if worker not in idle:
+                        waiting.setdefault(worker, []).append((envelope, payload))
+                        continue
+                    idle.remove(worker)
+                else:
+                    worker = idle.pop(0)
+                dispatch(worker, envelope, payload)
+    except (KeyboardInterrupt, Terminated):
+        print(f"Stopping {service} service")
+    finally:
+        if main_thread:
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for worker in idle:
+            backend_socket.send_multipart([worker, b"", STOP])
+        for process in processes:
+            process.join(2)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        for _, name in segments:
+            unlink_segment(name)
+        if frontend is not None:
+            frontend.close(linger=0)
+        if backend_socket is not None:
+            backend_socket.close(linger=0)
+        if context is not None:
+            context.term()
+        if backend.startswith("ipc://"):
+            try:
+                os.remove(backend[len("ipc://"):])
+            except OSError:
+                pass
+        if main_thread:
+            signal.signal(signal.SIGTERM, previous_handler)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the reference image services")
+    parser.add_argument("service", choices=sorted(SERVICES) + ["all"])
+    parser.add_argument("--bind", default=None, help="endpoint to listen on, defaults to the service's port")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes per service")
+    parser.add_argument("--ignore-quit", action="store_true", help="keep running when a client sends Q")
+    parser.add_argument("--session-ttl", type=int, default=600, help="seconds an unused session is kept")
+    parser.add_argument("--session-mb", type=int, default=512, help="session memory per worker")
+    parser.add_argument("--segment-ttl", type=int, default=30, help="seconds before unread v3 results are freed")
+    args = parser.parse_args()
+
+    if args.service == "all":
+        brokers = [multiprocessing.Process(target=serve, args=(service, None, args.workers, args.ignore_quit,
+                                                               args.session_ttl, args.session_mb, args.segment_ttl))
+                   for service in SERVICES]
+        signal.signal(signal.SIGTERM, raise_terminated)
+        for broker in brokers:
+            broker.start()
+        try:
+            for broker in brokers:
+                broker.join()
+        except (KeyboardInterrupt, Terminated) as e:
+            # Ctrl+C reaches the brokers too, SIGTERM only this process
+            for broker in brokers:
+                if isinstance(e, Terminated):
+                    broker.terminate()
+                broker.join(5)
+    else:
+        serve(args.service, args.bind, args.workers, args.ignore_quit, args.session_ttl, args.session_mb,
+              args.segment_ttl)